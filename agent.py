@@ -1,15 +1,28 @@
 # agent.py
 
-from llm import llm
-from graph import graph
+import contextvars
+import queue
+import threading
+import time
+import streamlit as st
+from services import get_graph, get_llm, lazy, session_scope, shared_resource
 from utils import get_session_id
-from tools.vector import get_medic_docs
-from tools.table import generate_dynamic_table
+from tools.vector import corpus_version, documents, get_embedding, get_medic_docs, search_documents
+from tools.answer_cache import SemanticAnswerCache
+from tools.context import count_tokens
+from history import WindowedChatHistory, format_chat_history
+from tracing import new_request_id, record_span, span, start_request
+from tools.table import build_citation_table
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
 from langchain.schema import BaseOutputParser
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain.tools import Tool
-from langchain_community.chat_message_histories import Neo4jChatMessageHistory
+from langchain_community.callbacks import get_openai_callback
+from langchain_community.callbacks.openai_info import (
+    MODEL_COST_PER_1K_TOKENS, get_openai_token_cost_for_model, standardize_model_name,
+)
 from langchain.agents import AgentExecutor, create_react_agent
+from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
 
@@ -27,31 +40,48 @@ chat_prompt = ChatPromptTemplate.from_messages(
     ]
 )
 
-medic_chat = chat_prompt | llm | LenientOutputParser()
+# The chains are built on first use, so importing this module doesn't create the LLM client
+@lazy
+def get_medic_chat():
+    return chat_prompt | get_llm() | LenientOutputParser()
+
+# Documents and pages retrieved while answering the current request, rendered as its citation table
+_citations = contextvars.ContextVar("citations", default=None)
+
+def collect_citations(metadata):
+    citations = _citations.get()
+    if citations is not None:
+        citations.extend(metadata)
+
+def query_regulation_documents(input_text):
+    results = get_medic_docs(input_text)
+    for result in results.values():
+        collect_citations(result["metadata"])
+    return results
 
 # Create a set of tools
 tools = [
     # Tool.from_function(
     #     name="General Chat",
     #     description="For general medical inquiries not covered by other tools",
-    #     func=medic_chat.invoke,
+    #     func=get_medic_chat().invoke,
     # ), 
     Tool.from_function(
         name="Query Regulation Documents",
         description="For when a user needs information about Medical practices as strictly described in the documents and it uses vector search",
-        func=get_medic_docs,
+        func=query_regulation_documents,
     ),
 ]
 
 # Create chat history callback
 def get_memory(session_id):
-    return Neo4jChatMessageHistory(session_id=session_id, graph=graph)
+    # The last turns within a token budget plus a summary of the earlier ones, see history.py
+    return WindowedChatHistory(session_id=session_id, graph=get_graph())
 
 # Create the agent
 agent_prompt_text =  """
 Role and Objective:
 You are an agent specialized in giving detailed answers based on documents. You will analyze and provide guidance based on documents from five medical associations using the "Query Regulation Documents" tool and other available tools to complete the tasks effectively.
-The table should be classified by document information.
 
 One important information page number and document that the information came from are mandatory
 
@@ -85,37 +115,284 @@ Action Input: the input to the action Observation: the result of the action
 When you have a response to say to the Human, or if you do not need to use a tool, you MUST use the format:
 
 Thought: Do I need to use a tool? No 
-Final Answer: [Ensure the final answer strictly follows markdown syntax. The title should always start with one #. The final answer should be comprehensive, starting with a title, followed by a highly detailed table, clearly referencing the documents, including document names (which should be shortened to contain only necessary information when the document name is too long) and page numbers always. After the table, provide a "Summary Report" section in bullet points, with detailed explanations for each point. At the complete end, mention the documents where no answers were found or where only closely related information was found.]
+Final Answer: [Ensure the final answer strictly follows markdown syntax. The title should always start with one #. The final answer should be comprehensive, starting with a title, followed by a "Summary Report" section in bullet points, with detailed explanations for each point that name the document (shortened to contain only necessary information when the document name is too long) and page number it comes from. Do not write a table of documents and pages, it is generated from the retrieved sources and added after your answer. At the complete end, mention the documents where no answers were found or where only closely related information was found.]
 
 When you have a response to say to the Human, or if you do not need to use a tool, you MUST use the format:
 
 
 Additional Context:
+Previous Conversation History: {chat_history}
 New Input: {input}
 Agent Scratchpad: {agent_scratchpad}
 """
 
+agent_prompt = PromptTemplate.from_template(agent_prompt_text)
 
-#Previous Conversation History: {chat_history}
+@lazy
+def get_chat_agent():
+    agent = create_react_agent(get_llm(), tools, agent_prompt)
+    agent_executor = AgentExecutor(
+        agent=agent,
+        tools=tools,
+        verbose=True,
+    )
 
+    # The prompt is a plain string, the history messages are rendered as text
+    agent_with_history = RunnablePassthrough.assign(
+        chat_history=lambda inputs: format_chat_history(inputs["chat_history"])
+    ) | agent_executor
 
-agent_prompt = PromptTemplate.from_template(agent_prompt_text)
-agent = create_react_agent(llm, tools, agent_prompt)
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=True,
-)
+    return RunnableWithMessageHistory(
+        agent_with_history,
+        get_memory,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+    )
+
+# Create a handler to call the agent
+
+FINAL_ANSWER_MARKER = "Final Answer:"
+DIRECT_ANSWER_TAG = "direct_answer"
+
+# "agent" always runs the ReAct agent, "direct" always answers from one retrieval and one LLM call,
+# "auto" takes the direct path and falls back to the agent when retrieval finds nothing
+RESPONSE_MODE = st.secrets.get("RESPONSE_MODE", "agent")
+RESPONSE_MODES = ("agent", "direct", "auto")
+if RESPONSE_MODE not in RESPONSE_MODES:
+    raise ValueError(f"Unknown RESPONSE_MODE: {RESPONSE_MODE}, expected one of {', '.join(RESPONSE_MODES)}")
+
+# Answers reused for questions whose embedding is close enough to one already answered
+ANSWER_CACHE_ENABLED = bool(st.secrets.get("ANSWER_CACHE_ENABLED", True))
+
+# Shared by all sessions, an answer cached for one user serves similar first questions of the others
+@shared_resource
+def get_answer_cache():
+    return SemanticAnswerCache(
+        threshold=float(st.secrets.get("ANSWER_CACHE_THRESHOLD", 0.95)),
+        ttl=float(st.secrets.get("ANSWER_CACHE_TTL_SECONDS", 3600)),
+        max_entries=int(st.secrets.get("ANSWER_CACHE_SIZE", 512)),
+    )
+
+UNPARSED_OUTPUT = "The output could not be parsed, please try again."
+# What AgentExecutor returns instead of an answer when it hits its iteration or time limit
+AGENT_STOPPED_OUTPUT = "Agent stopped due to iteration limit or time limit."
+NON_ANSWERS = (UNPARSED_OUTPUT, AGENT_STOPPED_OUTPUT)
+
+class StreamingEventHandler(BaseCallbackHandler):
+    """
+    Forwards the agent's progress and the tokens of its final answer to a queue,
+    so the UI can render them while the agent is still running.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self._buffer = ""
+        self._answering = False
 
-chat_agent = RunnableWithMessageHistory(
-    agent_executor,
-    get_memory,
-    input_messages_key="input",
-    history_messages_key="chat_history",
+    def on_llm_start(self, serialized, prompts, tags=None, **kwargs):
+        self._buffer = ""
+        # The direct path's answer has no ReAct reasoning in front of it
+        self._answering = DIRECT_ANSWER_TAG in (tags or [])
+        self.events.put(("status", "Analyzing..."))
+
+    def on_llm_new_token(self, token, **kwargs):
+        if self._answering:
+            self.events.put(("token", token))
+            return
+
+        # Only what follows "Final Answer:" is meant for the user, the rest is the agent's reasoning
+        self._buffer += token
+        position = self._buffer.find(FINAL_ANSWER_MARKER)
+        if position >= 0:
+            self._answering = True
+            answer_start = self._buffer[position + len(FINAL_ANSWER_MARKER):].lstrip()
+            if answer_start:
+                self.events.put(("token", answer_start))
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.events.put(("status", f"Finding relevant regulations for: {input_str}"))
+
+    def on_tool_end(self, output, **kwargs):
+        self.events.put(("status", "Reading through regulations..."))
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    Records a span for every LLM and tool call of a request, with token counts for the LLM calls.
+    """
+
+    def __init__(self):
+        self._started = {}
+
+    def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        self._started[run_id] = (time.perf_counter(), sum(count_tokens(prompt) for prompt in prompts))
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        started, prompt_tokens = self._started.pop(run_id, (time.perf_counter(), 0))
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        # Streamed responses come without usage, count the generated text instead
+        completion_tokens = usage.get("completion_tokens") or sum(
+            count_tokens(generation.text) for generations in response.generations for generation in generations
+        )
+        record_span("llm", time.perf_counter() - started, {
+            "prompt_tokens": usage.get("prompt_tokens") or prompt_tokens,
+            "completion_tokens": completion_tokens,
+        })
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        started, _ = self._started.pop(run_id, (time.perf_counter(), 0))
+        record_span("llm", time.perf_counter() - started, {"error": str(error)})
+
+    def on_tool_start(self, serialized, input_str, run_id=None, **kwargs):
+        self._started[run_id] = (time.perf_counter(), 0)
+
+    def on_tool_end(self, output, run_id=None, name=None, **kwargs):
+        started, _ = self._started.pop(run_id, (time.perf_counter(), 0))
+        record_span("tool", time.perf_counter() - started, {"tool": name})
+
+def parse_agent_response(response):
+    # Attempt to parse the 'output' key first
+    if 'output' in response:
+        return response['output']
     
-)
+    # Fallback: Handle cases where output is nested or misformatted
+    elif isinstance(response, dict):
+        # If there's any text key or field in response, return that
+        for key in response:
+            if isinstance(response[key], str):
+                return response[key]
+    
+    # Fallback message in case of issues
+    return UNPARSED_OUTPUT
 
-# Create a handler to call the agent
+def invoke_agent(user_input, session_id, callbacks=None):
+    response = get_chat_agent().invoke(
+        {"input": user_input},
+        config={"configurable": {"session_id": session_id}, "callbacks": callbacks or []}
+    )
+    
+    # Log the full response for debugging
+    print(f"Full response: {response}")
+    
+    return parse_agent_response(response)
+
+def retrieve_context(user_input, top_k=5):
+    """
+    Retrieves the context of a single LLM call: the hits of all documents merged,
+    with chunks deduplicated across documents and packed into the token budget.
+    """
+    merged = search_documents(user_input, top_k=top_k, merged_k=top_k * len(documents))["merged"]
+    if not merged["context"]:
+        return ""
+    collect_citations(merged["metadata"])
+    sources = "\n".join(f"- {item['document_name']}, page {item['page_number']}" for item in merged["metadata"])
+    return f"{merged['context']}\n\nSources:\n{sources}"
+
+def answer_directly(user_input, context, session_id, callbacks=None):
+    """
+    Single-pass RAG: answers from the retrieved context with one call to the medic_chat chain.
+    """
+    # Keep the conversation in the same history the agent uses
+    memory = get_memory(session_id)
+    history = format_chat_history(memory.messages)
+    answer = get_medic_chat().invoke(
+        {"input": f"Previous conversation:\n{history}\n\nDocuments:\n{context}\n\nName the document and page number of the information you use in the text. Don't write a table of sources, it is added after your answer.\n\nQuestion: {user_input}"},
+        config={"callbacks": callbacks or [], "tags": [DIRECT_ANSWER_TAG]},
+    )
+
+    memory.add_user_message(user_input)
+    memory.add_ai_message(answer)
+    return answer
+
+def usage_cost(usage):
+    """
+    Cost in USD of the tokens counted by get_openai_callback(). Streamed responses don't carry the
+    model name, so the callback leaves them at $0 and they are priced with the configured model.
+    """
+    if usage.total_cost:
+        return usage.total_cost
+    model_name = standardize_model_name(st.secrets["OPENAI_MODEL"])
+    if model_name not in MODEL_COST_PER_1K_TOKENS:
+        return 0.0
+    return (get_openai_token_cost_for_model(model_name, usage.prompt_tokens)
+            + get_openai_token_cost_for_model(model_name, usage.completion_tokens, is_completion=True))
+
+def respond(user_input, session_id, callbacks=None, status=None, request_id=None):
+    """
+    Answers through the path selected by RESPONSE_MODE and logs which path was taken,
+    with its latency and token spend. Opening questions similar to one answered before are served from the answer cache.
+    """
+    # Neo4j queries run by this thread for the request share one session
+    with start_request("respond", request_id=request_id, mode=RESPONSE_MODE) as trace, session_scope():
+        callbacks = list(callbacks or []) + [TracingCallbackHandler()]
+        output, path, usage = _respond(user_input, session_id, callbacks, status)
+        trace.attributes["path"] = path
+        if usage is not None:
+            trace.attributes["total_tokens"] = usage.total_tokens
+            trace.attributes["total_cost"] = usage_cost(usage)
+
+    if usage is None:
+        print(f"Response path: {path}, {trace.duration:.2f}s, hit rate {get_answer_cache().stats()['hit_rate']:.2f}")
+    else:
+        print(f"Response path: {path} (mode {RESPONSE_MODE}), {trace.duration:.2f}s, "
+              f"{usage.total_tokens} tokens, ${usage_cost(usage):.4f}")
+    return output
+
+def _respond(user_input, session_id, callbacks, status):
+    path = RESPONSE_MODE
+    # Answers given within a conversation can depend on it, only first questions share cached answers
+    use_cache = ANSWER_CACHE_ENABLED and not get_memory(session_id).has_history()
+
+    if use_cache:
+        # The query embedding is cached too, so retrieval doesn't compute it again
+        query_embedding = get_embedding(user_input)
+        version = corpus_version()
+        # Without the document versions a cached answer could be outdated
+        use_cache = version is not None
+
+    if use_cache:
+        with span("answer_cache.lookup") as record:
+            cached_answer = get_answer_cache().lookup(query_embedding, version)
+            record["hit"] = cached_answer is not None
+        if cached_answer is not None:
+            memory = get_memory(session_id)
+            memory.add_user_message(user_input)
+            memory.add_ai_message(cached_answer)
+            return cached_answer, "cache", None
+
+    citations = []
+    token = _citations.set(citations)
+    try:
+        with get_openai_callback() as usage:
+            if path in ("direct", "auto"):
+                if status:
+                    status("Finding relevant regulations...")
+                context = retrieve_context(user_input)
+                if context or path == "direct":
+                    path = "direct"
+                    output = answer_directly(user_input, context, session_id, callbacks=callbacks)
+                else:
+                    # Nothing was retrieved directly, let the agent try with its own queries
+                    path = "agent"
+
+            if path == "agent":
+                output = invoke_agent(user_input, session_id, callbacks=callbacks)
+    finally:
+        _citations.reset(token)
+
+    answered = output.strip() not in NON_ANSWERS
+    # The LLM only writes the prose, the citation table comes from the retrieval metadata
+    if answered:
+        with span("citation_table", pages=len(citations)):
+            table = build_citation_table(citations)
+        if table:
+            output = f"{output.rstrip()}\n\n## Sources\n\n{table}"
+
+    # Only answers grounded in retrieved documents are served to other questions,
+    # not fallbacks or answers to an empty context
+    if use_cache and answered and citations:
+        get_answer_cache().put(query_embedding, output, version)
+
+    return output, path, usage
 
 def generate_response(user_input):
     """
@@ -125,29 +402,50 @@ def generate_response(user_input):
     
     try:
         # Invoke the agent with error handling enabled for parsing
-        response = chat_agent.invoke(
-            {"input": user_input},
-            config={"configurable": {"session_id": get_session_id()}}
-        )
-        
-        # Log the full response for debugging
-        print(f"Full response: {response}")
-        
-        # Attempt to parse the 'output' key first
-        if 'output' in response:
-            return response['output']
-        
-        # Fallback: Handle cases where output is nested or misformatted
-        elif isinstance(response, dict):
-            # If there's any text key or field in response, return that
-            for key in response:
-                if isinstance(response[key], str):
-                    return response[key]
-        
-        # Fallback message in case of issues
-        return "The output could not be parsed, please try again."
+        return respond(user_input, get_session_id())
     
     except Exception as e:
         # Handle any exceptions (e.g., parsing, execution issues)
         print(f"Error encountered: {e}")
-        return f"An error occurred during processing: {str(e)}"
\ No newline at end of file
+        return f"An error occurred during processing: {str(e)}"
+
+def stream_response(user_input):
+    """
+    Streaming counterpart of generate_response.
+
+    Yields events as the agent runs:
+    {"type": "status", "text": ...} when the agent moves to a new stage,
+    {"type": "token", "text": ...} for each token of the final answer,
+    {"type": "final", "text": ..., "request_id": ...} once, with the complete answer to save in the chat history
+    and the id of its trace.
+    """
+    events = queue.Queue()
+    request_id = new_request_id()
+    # The Streamlit session is only available on the script thread
+    session_id = get_session_id()
+    result = {}
+
+    def run():
+        try:
+            result["output"] = respond(
+                user_input,
+                session_id,
+                callbacks=[StreamingEventHandler(events)],
+                status=lambda text: events.put(("status", text)),
+                request_id=request_id,
+            )
+        except Exception as e:
+            print(f"Error encountered: {e}")
+            result["output"] = f"An error occurred during processing: {str(e)}"
+        finally:
+            events.put(("done", None))
+
+    threading.Thread(target=run, daemon=True).start()
+
+    while True:
+        kind, text = events.get()
+        if kind == "done":
+            break
+        yield {"type": kind, "text": text}
+
+    yield {"type": "final", "text": result["output"], "request_id": request_id}
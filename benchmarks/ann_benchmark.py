@@ -0,0 +1,103 @@
+"""
+    Offline benchmark of the FAISS index types available to retrieval.
+
+    Reports recall@k against the exact flat index, p50/p99 single-query search latency,
+    build time and index memory, on synthetic embeddings or on embeddings exported to a .npy file.
+
+    Usage:
+    python -m benchmarks.ann_benchmark --count 50000 --dimension 1536
+    python -m benchmarks.ann_benchmark --embeddings exported_entities.npy --nprobe 16 --ef-search 128
+"""
+import argparse
+import time
+
+import numpy as np
+
+from tools.index_factory import INDEX_TYPES, build_index, index_memory_bytes
+
+
+def synthetic_embeddings(count, dimension, clusters=100, seed=0):
+    # Clustered data resembles real entity embeddings better than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    assignments = rng.integers(0, clusters, size=count)
+    embeddings = centers[assignments] + 0.3 * rng.normal(size=(count, dimension)).astype(np.float32)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def recall_at_k(found, expected):
+    hits = sum(len(set(row_found) & set(row_expected)) for row_found, row_expected in zip(found, expected))
+    return hits / expected.size
+
+
+def benchmark_index(index, queries, k):
+    latencies = []
+    found = []
+    for query in queries:
+        started = time.perf_counter()
+        _, indices = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - started)
+        found.append(indices[0])
+    return np.array(found), np.array(latencies) * 1000
+
+
+def run(embeddings, queries, k, index_types, nprobe, ef_search):
+    results = []
+    baseline = None
+    for index_type in index_types:
+        started = time.perf_counter()
+        index = build_index(embeddings, index_type, nprobe=nprobe, ef_search=ef_search)
+        build_seconds = time.perf_counter() - started
+
+        found, latencies = benchmark_index(index, queries, k)
+        if baseline is None:
+            # The first index is always the exact flat index
+            baseline = found
+
+        results.append({
+            "index_type": index_type,
+            "built_as": type(index).__name__,
+            "build_seconds": build_seconds,
+            "recall": recall_at_k(found, baseline),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "memory_mb": index_memory_bytes(index) / 2 ** 20,
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types against the exact flat index.")
+    parser.add_argument("--embeddings", help="Exported (N, d) float32 embeddings in .npy format")
+    parser.add_argument("--count", type=int, default=20000, help="Number of synthetic embeddings")
+    parser.add_argument("--dimension", type=int, default=1536, help="Dimension of synthetic embeddings")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--k", type=int, default=5, help="Neighbours per query, as top_k in retrieval")
+    parser.add_argument("--nprobe", type=int, default=8, help="Lists visited per query for IVF indexes")
+    parser.add_argument("--ef-search", type=int, default=64, help="Search depth for HNSW")
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = np.ascontiguousarray(np.load(args.embeddings), dtype=np.float32)
+    else:
+        embeddings = synthetic_embeddings(args.count, args.dimension)
+
+    # Queries are perturbed copies of stored vectors, like questions close to an entity
+    rng = np.random.default_rng(1)
+    picks = rng.integers(0, len(embeddings), size=args.queries)
+    noise = 0.1 * embeddings.std() * rng.normal(size=(args.queries, embeddings.shape[1]))
+    queries = (embeddings[picks] + noise).astype(np.float32)
+
+    index_types = ["flat"] + [index_type for index_type in args.types if index_type != "flat"]
+    results = run(embeddings, queries, args.k, index_types, args.nprobe, args.ef_search)
+
+    print(f"{len(embeddings)} vectors of dimension {embeddings.shape[1]}, {args.queries} queries, k={args.k}")
+    print(f"{'index':<10} {'built as':<14} {'build s':>8} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8} {'memory MB':>10}")
+    for result in results:
+        print(f"{result['index_type']:<10} {result['built_as']:<14} {result['build_seconds']:8.2f} "
+              f"{result['recall']:9.3f} {result['p50_ms']:8.3f} {result['p99_ms']:8.3f} {result['memory_mb']:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+    Deterministic local stand-ins for the services the app talks to, used by the benchmark harness.
+
+    - FakeEmbedder: hash-seeded vectors with a configurable per-call latency instead of OpenAI embeddings.
+    - FakeChatModel: a chat model with configurable first-token and per-token latency that follows the
+      ReAct format (one tool call, then a final answer) and answers the direct path in one call.
+    - InMemoryGraph / FakeDriver: a Neo4j driver answering the Cypher used by tools/vector.py, upload.py
+      and the chat history.
+    - NoopS3: an S3 client that only counts the bytes it is given.
+
+    install_fakes() must run before agent, tools.vector or upload are imported, as they read
+    their settings from st.secrets at import time.
+"""
+import hashlib
+import re
+import time
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+from embeddings import EmbeddingBackend
+
+
+class FakeSecrets(dict):
+    """
+    Dict standing in for st.secrets, which also supports .get().
+    """
+
+
+class FakeEmbedder(EmbeddingBackend):
+    def __init__(self, dimension=1536, latency=0.0, per_text_latency=0.0):
+        self.model_id = f"fake-embedder-{dimension}"
+        self._dimension = dimension
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+        self.calls = 0
+
+    def vector(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self._dimension).astype(np.float32)
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        self.calls += 1
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return [self.vector(text).tolist() for text in texts]
+
+
+def make_fake_chat_model(first_token_latency=0.5, token_latency=0.01, answer_words=200):
+    """
+    Builds the fake chat model class lazily so importing this module doesn't require langchain.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+
+    class FakeChatModel(BaseChatModel):
+        streaming: bool = True
+
+        @property
+        def _llm_type(self):
+            return "fake-chat-model"
+
+        def _respond(self, prompt):
+            question = re.search(r"New Input: (.*)", prompt)
+            scratchpad = prompt.split("Agent Scratchpad:")[-1].strip() if "Agent Scratchpad:" in prompt else None
+            answer = " ".join(["Regulation"] * answer_words)
+
+            if scratchpad == "":
+                # First ReAct step: always use the retrieval tool
+                query = question.group(1).strip() if question else "regulations"
+                return f"Thought: Do I need to use a tool? Yes\nAction: Query Regulation Documents\nAction Input: {query}"
+            if scratchpad is not None:
+                return f"Thought: Do I need to use a tool? No\nFinal Answer: # Answer\n{answer}"
+            return f"# Answer\n{answer}"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            prompt = "\n".join(str(message.content) for message in messages)
+            text = self._respond(prompt)
+            time.sleep(first_token_latency)
+            tokens = re.findall(r"\S+\s*", text)
+            for token in tokens:
+                time.sleep(token_latency)
+                if run_manager is not None and self.streaming:
+                    run_manager.on_llm_new_token(token)
+            # Reported like ChatOpenAI does with stream_options include_usage
+            usage = {"input_tokens": len(prompt.split()), "output_tokens": len(tokens)}
+            usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text, usage_metadata=usage))])
+
+    return FakeChatModel()
+
+
+EagerResult = namedtuple("EagerResult", ["records", "summary", "keys"])
+
+
+class FakeRecord(dict):
+    def data(self):
+        return dict(self)
+
+
+class FakeResult:
+    def __init__(self, records):
+        self._records = [FakeRecord(record) for record in records]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def single(self):
+        return self._records[0] if self._records else None
+
+    def data(self):
+        return [record.data() for record in self._records]
+
+
+class InMemoryGraph:
+    """
+    In-memory graph answering the queries of this repository, recognised by their Cypher text.
+    """
+
+    def __init__(self):
+        self.entities = {}  # name -> {"file_name", "embedding", "descriptions", "chunks": [chunk ids]}
+        self.chunks = {}  # chunk id -> properties
+        self.documents = defaultdict(dict)  # file name -> properties
+        # chat session id -> {"messages": [(type, content)], "summary", "summarized_count"}
+        self.sessions = {}
+        self.vector_indexes = {}  # name -> SHOW VECTOR INDEXES row
+        self._vector_matrix = None
+        self.queries = 0
+
+    def add_document(self, file_name, embedder, entities=100, chunks_per_entity=3, chunk_chars=1000):
+        for number in range(entities):
+            name = f"{file_name}-entity-{number}"
+            chunk_ids = []
+            for chunk_number in range(chunks_per_entity):
+                chunk_id = f"{name}-chunk-{chunk_number}"
+                self.chunks[chunk_id] = {
+                    "content": f"{name} requirement {chunk_number} " + "x" * chunk_chars,
+                    "page_number": number // 5 + 1,
+                    "file_name": file_name,
+                }
+                chunk_ids.append(chunk_id)
+            self.entities[name] = {
+                "file_name": file_name,
+                "embedding": embedder.vector(name).tolist(),
+                "descriptions": f"Description of {name}",
+                "chunks": chunk_ids,
+            }
+        self.documents[file_name].update(version=1, embedding_model=embedder.model_id)
+
+    def run(self, query, parameters=None, **kwargs):
+        self.queries += 1
+        params = dict(parameters or {}, **kwargs)
+        # neo4j.Query carries a timeout next to the text
+        query = getattr(query, "text", query)
+
+        if "CREATE CONSTRAINT" in query or "CREATE INDEX" in query:
+            return FakeResult([])
+
+        # Native vector index on the entity embeddings
+        if "SHOW VECTOR INDEXES" in query:
+            index = self.vector_indexes.get(params["index_name"])
+            return FakeResult([index] if index else [])
+        if "CREATE VECTOR INDEX" in query:
+            name = re.search(r"CREATE VECTOR INDEX `?(\w+)`?", query).group(1)
+            self.vector_indexes.setdefault(name, {
+                "labelsOrTypes": ["Entity"], "properties": ["embedding"],
+                "options": {"indexConfig": {"vector.dimensions": params["dimension"],
+                                            "vector.similarity_function": params["similarity"].upper()}},
+            })
+            return FakeResult([])
+        if "DROP INDEX" in query:
+            self.vector_indexes.pop(re.search(r"DROP INDEX `?(\w+)`?", query).group(1), None)
+            return FakeResult([])
+        if "RETURN size(e.embedding) AS dimension" in query:
+            entity = next(iter(self.entities.values()), None)
+            return FakeResult([{"dimension": len(entity["embedding"])}] if entity else [])
+        if "db.index.vector.queryNodes" in query:
+            return FakeResult(self._vector_search(params))
+
+        if "RETURN e.name AS id, e.embedding AS embedding" in query:
+            return FakeResult(
+                {"id": name, "embedding": entity["embedding"]}
+                for name, entity in self.entities.items()
+                if entity["file_name"] == params["document_name"]
+            )
+
+        if "d.version AS version, count(e) AS entity_count" in query:
+            counts = defaultdict(int)
+            for entity in self.entities.values():
+                counts[entity["file_name"]] += 1
+            return FakeResult(
+                {"document_name": name, "version": self.documents.get(name, {}).get("version"), "entity_count": counts[name]}
+                for name in params["document_names"]
+            )
+
+        if "AS embedding_model" in query and "$document_name" in query:
+            # Entities don't record their model here, the document does
+            return FakeResult([{"embedding_model": self.documents.get(params["document_name"], {}).get("embedding_model")}])
+
+        if "UNWIND $entity_names AS entity_name" in query:
+            records = []
+            for name in params["entity_names"]:
+                entity = self.entities.get(name)
+                if entity is None:
+                    continue
+                records.append({
+                    "entity_name": name,
+                    "descriptions": entity["descriptions"],
+                    "connected_chunk_details": [
+                        {
+                            "content": self.chunks[chunk_id]["content"],
+                            "page_number": self.chunks[chunk_id]["page_number"],
+                            "filename": self.chunks[chunk_id]["file_name"],
+                        }
+                        for chunk_id in entity["chunks"]
+                    ],
+                })
+            return FakeResult(records)
+
+        if "MERGE (d:Chunk {chunk_id: row.chunk_id})" in query:
+            self.documents[params["file_name"]]["embedding_model"] = params["embedding_model"]
+            for row in params["rows"]:
+                chunk = self.chunks.setdefault(row["chunk_id"], {"file_name": params["file_name"]})
+                chunk.update(page_number=row["page_number"], position=row["position"])
+                # Rows without text and embedding only move an unchanged chunk
+                if row["text"] is not None:
+                    chunk["content"] = row["text"]
+                if row["embedding"] is not None:
+                    chunk.update(embedding=row["embedding"], embedding_model=params["embedding_model"])
+            return FakeResult([])
+
+        if "RETURN c.chunk_id AS chunk_id, c.embedding_model AS embedding_model" in query:
+            return FakeResult(
+                {"chunk_id": chunk_id, "embedding_model": chunk.get("embedding_model"),
+                 "page_number": chunk["page_number"], "position": chunk.get("position")}
+                for chunk_id, chunk in self.chunks.items()
+                if chunk["file_name"] == params["file_name"]
+            )
+
+        if "UNWIND $chunk_ids AS chunk_id" in query:
+            for chunk_id in params["chunk_ids"]:
+                self.chunks.pop(chunk_id, None)
+            return FakeResult([])
+
+        if "SET d.version = coalesce(d.version, 0) + 1" in query:
+            document = self.documents[params["file_name"]]
+            document["version"] = document.get("version", 0) + 1
+            return FakeResult([])
+
+        if "MERGE (doc)-[:RELATED_TO]->(other)" in query:
+            return FakeResult([])
+
+        # Chat history (history.WindowedChatHistory)
+        if "SET s.message_count = coalesce(s.message_count, 0) + 1" in query:
+            session = self.sessions.setdefault(params["session_id"], {"messages": [], "summary": None, "summarized_count": 0})
+            session["messages"].append((params["type"], params["content"]))
+            return FakeResult([{"message_count": len(session["messages"]), "summarized_count": session["summarized_count"]}])
+        if "AS messages" in query and "s.summary AS summary" in query:
+            session = self.sessions.get(params["session_id"])
+            if session is None:
+                return FakeResult([])
+            window = int(re.search(r"NEXT\*0\.\.(\d+)", query).group(1)) + 1
+            return FakeResult([{
+                "summary": session["summary"],
+                "messages": [{"data": {"content": content}, "type": message_type}
+                             for message_type, content in session["messages"][-window:]],
+            }])
+        if "RETURN s.message_count AS message_count" in query:
+            session = self.sessions.get(params["session_id"])
+            if session is None:
+                return FakeResult([])
+            return FakeResult([{"message_count": len(session["messages"]), "summary": session["summary"],
+                                "summarized_count": session["summarized_count"]}])
+        if "node.index > $start" in query:
+            messages = self.sessions[params["session_id"]]["messages"][params["start"]:params["through"]]
+            return FakeResult({"type": message_type, "content": content} for message_type, content in messages)
+        if "SET s.summary = $summary" in query:
+            session = self.sessions.get(params["session_id"])
+            if session is not None and session["summarized_count"] == params["summarized_count"]:
+                session.update(summary=params["summary"], summarized_count=params["through"])
+            return FakeResult([])
+        if "REMOVE s.summary" in query:
+            return FakeResult([])
+        if "DETACH DELETE" in query:
+            self.sessions.pop(params.get("session_id"), None)
+            return FakeResult([])
+
+        raise NotImplementedError(f"Query not supported by the in-memory graph:\n{query}")
+
+
+    def _vector_search(self, params):
+        # Exact euclidean search scored like Neo4j, 1 / (1 + d²), then filtered and hydrated like VECTOR_SEARCH_QUERY
+        if not self.entities:
+            return []
+        # Like the server's index, the vectors are kept ready between queries
+        if self._vector_matrix is None or len(self._vector_matrix[0]) != len(self.entities):
+            names = list(self.entities)
+            self._vector_matrix = (names, np.array([self.entities[name]["embedding"] for name in names], dtype=np.float32))
+        names, matrix = self._vector_matrix
+        query = np.asarray(params["embedding"], dtype=np.float32)
+        distances = ((matrix - query) ** 2).sum(axis=1)
+        nearest = np.argsort(distances)[:params["candidates"]]
+
+        per_document = defaultdict(list)
+        for position in nearest:
+            entity = self.entities[names[position]]
+            if entity["file_name"] in params["documents"]:
+                per_document[entity["file_name"]].append((names[position], 1.0 / (1.0 + float(distances[position]))))
+        records = []
+        for document, hits in sorted(per_document.items()):
+            for name, score in hits[:params["top_k"]]:
+                entity = self.entities[name]
+                records.append({
+                    "document": document, "entity_name": name, "score": score,
+                    "descriptions": entity["descriptions"],
+                    "connected_chunk_details": [
+                        {"content": self.chunks[chunk_id]["content"], "page_number": self.chunks[chunk_id]["page_number"],
+                         "filename": self.chunks[chunk_id]["file_name"]}
+                        for chunk_id in entity["chunks"]
+                    ],
+                })
+        return records
+
+
+class FakeTransaction:
+    def __init__(self, graph):
+        self._graph = graph
+
+    def run(self, query, parameters=None, **kwargs):
+        return self._graph.run(query, parameters, **kwargs)
+
+
+class FakeSession(FakeTransaction):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def close(self):
+        pass
+
+    def execute_write(self, work, *args, **kwargs):
+        return work(FakeTransaction(self._graph), *args, **kwargs)
+
+    def execute_read(self, work, *args, **kwargs):
+        return work(FakeTransaction(self._graph), *args, **kwargs)
+
+
+class FakeDriver:
+    def __init__(self, graph, round_trip_latency=0.0):
+        self.graph = graph
+        self.round_trip_latency = round_trip_latency
+
+    def session(self, **kwargs):
+        return _LatencySession(self.graph, self.round_trip_latency)
+
+    def execute_query(self, query, parameters=None, **kwargs):
+        time.sleep(self.round_trip_latency)
+        records = list(self.graph.run(query, parameters))
+        return EagerResult(records, None, list(records[0].keys()) if records else [])
+
+    def verify_connectivity(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _LatencySession(FakeSession):
+    # Every query pays the configured round-trip time, like a remote Neo4j instance
+    def __init__(self, graph, round_trip_latency):
+        super().__init__(_LatencyGraph(graph, round_trip_latency))
+
+
+class _LatencyGraph:
+    def __init__(self, graph, round_trip_latency):
+        self._graph = graph
+        self._latency = round_trip_latency
+
+    def run(self, query, parameters=None, **kwargs):
+        time.sleep(self._latency)
+        return self._graph.run(query, parameters, **kwargs)
+
+
+class FakeNeo4jGraph:
+    """
+    Stands in for langchain's Neo4jGraph, which the repository only uses for its driver.
+    """
+
+    def __init__(self, driver):
+        self._driver = driver
+        self._database = "neo4j"
+
+    def query(self, query, params=None):
+        records, _, _ = self._driver.execute_query(query, params or {})
+        return [dict(record) for record in records]
+
+
+class NoopS3:
+    def __init__(self):
+        self.uploaded_bytes = 0
+
+    def upload_file(self, file_path, bucket, key, **kwargs):
+        with open(file_path, "rb") as f:
+            self.uploaded_bytes += len(f.read())
+
+    def upload_fileobj(self, fileobj, bucket, key, **kwargs):
+        self.uploaded_bytes += len(fileobj.read())
+
+
+def install_fakes(secrets, embedder, chat_model, memory_graph, round_trip_latency=0.0):
+    """
+    Replaces st.secrets and the shared service clients (see services.py), so the repository's
+    modules run against the fakes.
+    """
+    import streamlit as st
+
+    st.secrets = FakeSecrets(secrets)
+
+    import services
+
+    driver = FakeDriver(memory_graph, round_trip_latency)
+    s3 = NoopS3()
+    services.get_graph.override(FakeNeo4jGraph(driver))
+    services.get_llm.override(chat_model)
+    services.get_embedding_model.override(embedder)
+    services.get_s3_client.override(s3)
+
+    return driver, s3
@@ -0,0 +1,259 @@
+"""
+    End-to-end benchmark of retrieval, ingestion and answering, without live credentials.
+
+    Neo4j, OpenAI and S3 are replaced with the deterministic fakes in benchmarks/fakes.py, so the
+    numbers measure this repository's own overhead plus the simulated service latencies.
+    For every stage it reports p50/p95/p99 latency, throughput, the peak RSS while the stage ran and
+    how far that peak rose above the RSS at its start.
+
+    Usage:
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --documents 5 --entities 2000 --llm-latency 0.5 --output bench.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmarks.fakes import FakeEmbedder, InMemoryGraph, install_fakes, make_fake_chat_model
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def current_rss_mb():
+    # The current RSS is only exposed in /proc on Linux, elsewhere the process peak so far stands in
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+class RssSampler:
+    """
+    Samples the RSS from a background thread while a stage runs, so the stage reports its own peak
+    instead of the highest RSS the process reached in any earlier stage.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start = self.peak = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+
+    def __enter__(self):
+        self.start = self.peak = current_rss_mb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+
+def measure(name, operation, iterations, reports_latency=False):
+    latencies = []
+    started = time.perf_counter()
+    with RssSampler() as rss:
+        for iteration in range(iterations):
+            operation_started = time.perf_counter()
+            result = operation(iteration)
+            # Some operations report their own latency, e.g. the time to the first token
+            latencies.append(result if reports_latency else time.perf_counter() - operation_started)
+    elapsed = time.perf_counter() - started
+
+    latencies = np.array(latencies) * 1000
+    return {
+        "stage": name,
+        "iterations": iterations,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "throughput_per_s": iterations / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": rss.peak,
+        "rss_growth_mb": rss.peak - rss.start,
+    }
+
+
+class FakeUploadedFile:
+    """
+    Mimics Streamlit's UploadedFile for upload_file_to_s3_and_neo4j.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self._data = data
+        self.size = len(data)
+
+    def getvalue(self):
+        return self._data
+
+    def getbuffer(self):
+        return memoryview(bytearray(self._data))
+
+
+def make_text_document(pages, chars_per_page, seed, edited_page=None):
+    words = ["storage", "temperature", "audit", "distribution", "record", "validation", "procedure", "shall"]
+
+    def page_text(page):
+        # Every page has its own generator, so editing one page leaves the others identical
+        rng = np.random.default_rng([seed, page, int(page == edited_page)])
+        return " ".join(rng.choice(words, size=chars_per_page // 8))
+
+    return "\f".join(page_text(page) for page in range(pages)).encode("utf-8")
+
+
+def run_stages(args, results, agent, upload, vector, embedder):
+    from tracing import span_counts
+
+    if args.retrieval_backend != "faiss":
+        from tools.retriever import ensure_vector_index
+
+        ensure_vector_index(vector.VECTOR_INDEX_NAME, embedder.dimension, vector.VECTOR_INDEX_SIMILARITY)
+    results.append(measure("retrieval_cold", lambda i: vector.get_medic_docs(f"cold question {i}"), 1))
+    results.append(measure("retrieval_warm", lambda i: vector.get_medic_docs(f"storage question {i}"), args.queries))
+
+    uploads = [
+        FakeUploadedFile(f"upload-{number}.txt", make_text_document(args.pages, 3000, number))
+        for number in range(args.uploads)
+    ]
+    def ingestion_stage(name, documents):
+        calls = embedder.calls
+        results.append(measure(name, lambda i: upload.upload_file_to_s3_and_neo4j(documents[i]), args.uploads))
+        results[-1]["embedding_requests"] = embedder.calls - calls
+
+    ingestion_stage("ingestion", uploads)
+    # Re-uploading unchanged and then one-page-edited documents only embeds what changed
+    ingestion_stage("reingestion_unchanged", uploads)
+    ingestion_stage("reingestion_one_page_edit", [
+        FakeUploadedFile(f"upload-{number}.txt", make_text_document(args.pages, 3000, number, edited_page=args.pages // 2))
+        for number in range(args.uploads)
+    ])
+
+    results.append(measure(
+        f"generate_response_{args.mode}",
+        lambda i: agent.generate_response(f"What are the storage requirements {i}?"),
+        args.responses,
+    ))
+
+    def first_token(i):
+        started = time.perf_counter()
+        first = None
+        for event in agent.stream_response(f"What are the audit requirements {i}?"):
+            if event["type"] == "token" and first is None:
+                first = time.perf_counter() - started
+        return first
+    results.append(measure(f"time_to_first_token_{args.mode}", first_token, args.responses, reports_latency=True))
+
+    if args.retrieval_backend == "neo4j":
+        # The answer cache's document versions are read on opening questions, the cache is off above
+        vector.corpus_version()
+        # The native index keeps the embeddings in the database, nothing may pull them to the client
+        transfers = {name: count for name, count in span_counts().items()
+                     if name in ("neo4j.fetch_embeddings", "snapshot.export")}
+        if transfers:
+            raise AssertionError(f"Embeddings were transferred with the neo4j retrieval backend: {transfers}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the request and ingestion paths against local fakes.")
+    parser.add_argument("--documents", type=int, default=5, help="Documents searched by retrieval")
+    parser.add_argument("--entities", type=int, default=1000, help="Entities per document")
+    parser.add_argument("--dimension", type=int, default=1536, help="Embedding dimension")
+    parser.add_argument("--queries", type=int, default=50, help="Retrieval queries per stage")
+    parser.add_argument("--responses", type=int, default=5, help="Answers generated per response stage")
+    parser.add_argument("--uploads", type=int, default=3, help="Documents ingested")
+    parser.add_argument("--pages", type=int, default=50, help="Pages per ingested document")
+    parser.add_argument("--embed-latency", type=float, default=0.05, help="Seconds per embedding request")
+    parser.add_argument("--neo4j-latency", type=float, default=0.01, help="Seconds per Neo4j round-trip")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds to the LLM's first token")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="Seconds per generated token")
+    parser.add_argument("--mode", default="agent", choices=["agent", "direct", "auto"], help="RESPONSE_MODE")
+    parser.add_argument("--retrieval-backend", default="faiss", choices=["faiss", "neo4j", "compare"],
+                        help="RETRIEVAL_BACKEND, compare prints both backends' latency and transfer size with --verbose")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the agent and the pipeline")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = tempfile.mkdtemp(prefix="medic-bench-")
+    secrets = {
+        "OPENAI_API_KEY": "fake", "OPENAI_MODEL": "fake",
+        "NEO4J_URI": "bolt://fake", "NEO4J_USERNAME": "neo4j", "NEO4J_PASSWORD": "fake",
+        "AWS_ACCESS_KEY": "fake", "AWS_SECRET_KEY": "fake", "AWS_REGION": "eu-central-1",
+        "S3_BUCKET_NAME": "fake",
+        "EMBEDDING_CACHE_PATH": "",
+        "ANSWER_CACHE_ENABLED": False,
+        "RESPONSE_MODE": args.mode,
+        "RETRIEVAL_BACKEND": args.retrieval_backend,
+    }
+
+    embedder = FakeEmbedder(args.dimension, latency=args.embed_latency)
+    chat_model = make_fake_chat_model(args.llm_latency, args.token_latency)
+    memory_graph = InMemoryGraph()
+    document_names = [f"benchmark-document-{number}.pdf" for number in range(args.documents)]
+    for document_name in document_names:
+        memory_graph.add_document(document_name, embedder, entities=args.entities)
+
+    install_fakes(secrets, embedder, chat_model, memory_graph, round_trip_latency=args.neo4j_latency)
+
+    # Streamlit warns about every st.* call made outside `streamlit run`
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+    # Imported only now, so they bind to the fakes
+    import agent
+    import services
+    import upload
+    from tools import vector
+
+    vector.documents[:] = document_names
+    agent.get_session_id = lambda: "benchmark-session"
+    os.chdir(workdir)
+
+    results = []
+    # The agent and the ingestion print a lot, keep the report readable unless asked otherwise
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with quiet:
+        run_stages(args, results, agent, upload, vector, embedder)
+
+    print(f"\n{args.documents} documents x {args.entities} entities, dimension {args.dimension}, "
+          f"{args.retrieval_backend} retrieval, "
+          f"{memory_graph.queries} Neo4j queries, {embedder.calls} embedding requests")
+    sessions = services.pool_stats()
+    print(f"Neo4j sessions: {sessions['sessions_opened']} opened, {sessions['sessions_reused']} reused, "
+          f"{sessions['sessions_peak_open']} open at peak")
+    print(f"{'stage':<32} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ops/s':>8} {'peak RSS MB':>12} "
+          f"{'RSS +MB':>8}")
+    for result in results:
+        print(f"{result['stage']:<32} {result['iterations']:>4} {result['p50_ms']:9.1f} {result['p95_ms']:9.1f} "
+              f"{result['p99_ms']:9.1f} {result['throughput_per_s']:8.2f} {result['peak_rss_mb']:12.1f} "
+              f"{result['rss_growth_mb']:8.1f}")
+    for result in results:
+        if "embedding_requests" in result:
+            print(f"{result['stage']}: {result['embedding_requests']} embedding requests")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+    Startup report: what importing the app costs before the first question is asked.
+
+    The modules are imported in a fresh interpreter with `python -X importtime`, with placeholder
+    secrets only, so any client still created at import time fails loudly instead of being timed.
+    The report lists the import time of the repository's modules, the heaviest third-party
+    packages, the RSS after importing and which heavy libraries were (not) loaded.
+
+    Usage:
+    python -m benchmarks.startup_report
+    python -m benchmarks.startup_report --modules agent upload --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that should only load when the feature using them runs
+HEAVY_MODULES = ["torch", "sentence_transformers", "transformers", "boto3", "fitz", "docx", "neo4j"]
+
+CHILD = """
+import json, resource, sys, time
+import streamlit as st
+from benchmarks.fakes import FakeSecrets
+
+st.secrets = FakeSecrets({secrets!r})
+started = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    "elapsed_s": elapsed,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    Parses `-X importtime` output into (module, self seconds, cumulative seconds) rows.
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        rows.append((module.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return rows
+
+
+def repository_modules():
+    names = set()
+    for directory, _, files in os.walk(ROOT):
+        if "benchmarks" in directory or "/." in directory:
+            continue
+        package = os.path.relpath(directory, ROOT).replace(os.sep, ".")
+        for file in files:
+            if file.endswith(".py"):
+                module = file[:-3]
+                names.add(module if package == "." else f"{package}.{module}")
+    return names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report the import time and memory of the app's modules.")
+    parser.add_argument("--modules", nargs="+", default=["agent", "upload"], help="Modules to import")
+    parser.add_argument("--top", type=int, default=10, help="Third-party packages listed")
+    args = parser.parse_args()
+
+    secrets = {
+        "OPENAI_API_KEY": "unused", "OPENAI_MODEL": "unused",
+        "NEO4J_URI": "bolt://unused", "NEO4J_USERNAME": "unused", "NEO4J_PASSWORD": "unused",
+        "AWS_ACCESS_KEY": "unused", "AWS_SECRET_KEY": "unused", "AWS_REGION": "unused",
+        "S3_BUCKET_NAME": "unused", "EMBEDDING_CACHE_PATH": "",
+    }
+    code = CHILD.format(secrets=secrets, modules=args.modules, heavy=HEAVY_MODULES)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        sys.exit(f"Importing {', '.join(args.modules)} failed:\n{completed.stderr[-2000:]}")
+    summary = json.loads(completed.stdout.strip().splitlines()[-1])
+    rows = parse_importtime(completed.stderr)
+
+    own = repository_modules()
+    packages = defaultdict(float)
+    for module, self_time, _ in rows:
+        top_level = module.split(".")[0]
+        if top_level not in own:
+            packages[top_level] += self_time
+
+    print(f"Imported {', '.join(args.modules)} in {summary['elapsed_s']:.2f}s, RSS {summary['rss_mb']:.1f} MB")
+    heavy = set(summary["loaded"])
+    print("Heavy libraries: " + ", ".join(
+        f"{name} ({'loaded' if name in heavy else 'not loaded'})" for name in HEAVY_MODULES
+    ))
+
+    print(f"\n{'repository module':<32} {'cumulative ms':>14}")
+    for module, _, cumulative in rows:
+        if module in own:
+            print(f"{module:<32} {cumulative * 1000:14.1f}")
+
+    print(f"\n{'third-party package':<32} {'self ms':>14}")
+    for package, self_time in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{package:<32} {self_time * 1000:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
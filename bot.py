@@ -1,13 +1,17 @@
 import streamlit as st
-import time
-from utils import write_message
-from agent import generate_response
+from utils import get_session_id, write_message
+from agent import get_answer_cache
+from query_service import QueryServiceError, get_query_service
+from tools.vector import get_embedding_cache
+from services import pool_stats
+import tracing
 
 # Page Config
 st.set_page_config(page_title="Medical RAG", page_icon=":hospital:")
 
 # Create a sidebar for navigation between pages (without the upload page)
 page = st.sidebar.selectbox("Navigate", ["Chat with Assistant"])
+show_timings = st.sidebar.checkbox("Show timings")
 
 # Set up Session State for Chat Page
 if page == "Chat with Assistant":
@@ -19,30 +23,40 @@ if page == "Chat with Assistant":
     # Submit handler
     def handle_submit(message):
         """
-        Handles the submit of chat messages and generates a response using Neo4j data.
+        Handles the submit of chat messages and streams the response generated using Neo4j data.
         """
-        # List of spinner messages
-        spinner_texts = [
-            'Finding relevant regulations...',
-            'Reading through regulations...',
-            'Analyzing...',
-            'Almost done...'
-        ]
-
-        # Show progress spinner while processing
-        with st.spinner('Taking a deep breath...'):
-            for text in spinner_texts:
-                st.spinner(text)
-                time.sleep(1)
+        response = ""
+        with st.chat_message('assistant'):
+            # Progress states follow the agent's real stages
+            status = st.status('Taking a deep breath...')
+            answer = st.empty()
 
-            # Call the agent and handle possible errors
             try:
-                response = generate_response(message)
-                write_message('assistant', response)
+                # The query service answers, coalescing identical questions asked at the same time
+                for event in get_query_service().stream_answer(message, get_session_id()):
+                    if event["type"] == "status":
+                        status.update(label=event["text"])
+                    elif event["type"] == "token":
+                        response += event["text"]
+                        answer.markdown(response + "▌")
+                    elif event["type"] == "final":
+                        response = event["text"]
+                        st.session_state.last_request_id = event["request_id"]
+                status.update(label='Done', state='complete')
+            except QueryServiceError as e:
+                # Saturated or too slow, the message tells the user what to do
+                status.update(label='Not answered', state='error')
+                st.warning(str(e))
+                response = str(e)
             except Exception as e:
                 # Handle parsing errors gracefully
+                status.update(label='Failed', state='error')
                 st.error(f"An error occurred: {str(e)}")
-                write_message('assistant', "Sorry, I encountered an error while processing the response.")
+                response = "Sorry, I encountered an error while processing the response."
+
+            answer.markdown(response)
+
+        st.session_state.messages.append({"role": "assistant", "content": response})
 
     # Display messages in the chat
     for message in st.session_state.messages:
@@ -55,3 +69,16 @@ if page == "Chat with Assistant":
 
         # Generate a response
         handle_submit(question)
+
+    # Debug panel with the stage timings of the last answer
+    if show_timings:
+        trace = tracing.get_request(st.session_state.get("last_request_id"))
+        if trace is None:
+            st.sidebar.caption("No answer traced yet.")
+        else:
+            st.sidebar.write(f"Request {trace['request_id']}: {trace['duration_ms']:.0f} ms, path {trace.get('path')}")
+            st.sidebar.dataframe(trace["spans"], use_container_width=True)
+        st.sidebar.write("Embedding cache", get_embedding_cache().stats())
+        st.sidebar.write("Answer cache", get_answer_cache().stats())
+        st.sidebar.write("Neo4j pool", pool_stats())
+        st.sidebar.write("Query service", get_query_service().stats())
@@ -0,0 +1,114 @@
+"""
+    Embedding backends shared by retrieval (tools/vector.py) and ingestion (upload.py).
+
+    Every backend exposes embed_query/embed_documents like the LangChain embeddings,
+    plus the model id and dimension that are stored next to the vectors in Neo4j.
+    The dimension matters: an index built with 384-dimension vectors can't be searched
+    with 1536-dimension queries (see actions.txt).
+"""
+import os
+
+import streamlit as st
+
+
+class EmbeddingBackend:
+    model_id = None
+    # Requests in flight during ingestion, None leaves it to EMBEDDING_MAX_CONCURRENCY
+    max_concurrency = None
+    _dimension = None
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts):
+        raise NotImplementedError
+
+    @property
+    def dimension(self):
+        if self._dimension is None:
+            self._dimension = len(self.embed_query("dimension probe"))
+        return self._dimension
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """
+    OpenAI embeddings through LangChain, the default backend.
+    """
+
+    def __init__(self, api_key, model_name=None):
+        from langchain_openai import OpenAIEmbeddings
+
+        options = {"model": model_name} if model_name else {}
+        self._embeddings = OpenAIEmbeddings(openai_api_key=api_key, **options)
+        self.model_id = self._embeddings.model
+
+    def embed_query(self, text):
+        return self._embeddings.embed_query(text)
+
+    def embed_documents(self, texts):
+        return self._embeddings.embed_documents(texts)
+
+
+class LocalEmbeddingBackend(EmbeddingBackend):
+    """
+    Sentence-transformers model running on the local CPU, without network round-trips or per-token cost.
+
+    Parameters:
+    model_name (str): Hugging Face model name.
+    batch_size (int): Texts encoded per forward pass.
+    num_threads (int): Torch intra-op threads, defaults to the number of CPU cores.
+    quantize (bool): Apply dynamic int8 quantization to the linear layers (torch runtime only).
+    runtime (str): "torch" or "onnx" (requires sentence-transformers >= 3.2 with onnxruntime).
+    """
+
+    # Encoding already uses every core, concurrent batches would only compete for them
+    max_concurrency = 1
+
+    def __init__(self, model_name, batch_size=32, num_threads=None, quantize=False, runtime="torch"):
+        # Imported here so the OpenAI backend never pays for loading torch
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(num_threads or os.cpu_count() or 1)
+
+        if runtime == "onnx":
+            self._model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        else:
+            self._model = SentenceTransformer(model_name, device="cpu")
+            if quantize:
+                self._model = torch.quantization.quantize_dynamic(self._model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.batch_size = batch_size
+        self.model_id = model_name + ("-int8" if quantize and runtime == "torch" else "")
+        self._dimension = self._model.get_sentence_embedding_dimension()
+
+    def embed_documents(self, texts):
+        embeddings = self._model.encode(
+            list(texts),
+            batch_size=self.batch_size,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        return embeddings.astype("float32").tolist()
+
+
+def create_embedding_backend(name=None):
+    """
+    Creates the backend selected by EMBEDDING_BACKEND in the secrets: "openai" (default) or "local".
+    """
+    name = name or st.secrets.get("EMBEDDING_BACKEND", "openai")
+    if name == "openai":
+        return OpenAIEmbeddingBackend(
+            st.secrets["OPENAI_API_KEY"],
+            model_name=st.secrets.get("OPENAI_EMBEDDING_MODEL"),
+        )
+    if name == "local":
+        threads = st.secrets.get("LOCAL_EMBEDDING_THREADS")
+        return LocalEmbeddingBackend(
+            st.secrets.get("LOCAL_EMBEDDING_MODEL", "sentence-transformers/msmarco-MiniLM-L-12-v3"),
+            batch_size=int(st.secrets.get("LOCAL_EMBEDDING_BATCH_SIZE", 32)),
+            num_threads=int(threads) if threads else None,
+            quantize=bool(st.secrets.get("LOCAL_EMBEDDING_QUANTIZE", False)),
+            runtime=st.secrets.get("LOCAL_EMBEDDING_RUNTIME", "torch"),
+        )
+    raise ValueError(f"Unsupported embedding backend: {name}")
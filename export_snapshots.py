@@ -0,0 +1,33 @@
+"""
+    Exports the entity embeddings of the searched documents to compact snapshot files.
+
+    Retrieval exports a document's snapshot on its first cold load anyway; running this after
+    ingesting (or before starting more Streamlit workers) keeps that export off the request path.
+
+    Usage:
+    python export_snapshots.py
+    python export_snapshots.py --documents some-document.pdf
+"""
+import argparse
+import os
+import time
+
+from tools.snapshot import open_snapshot
+from tools.vector import EMBEDDING_SNAPSHOT_DIR, documents, export_document_snapshot
+
+def main():
+    parser = argparse.ArgumentParser(description="Export entity embeddings to memory-mappable snapshots.")
+    parser.add_argument("--documents", nargs="+", default=documents, help="Documents to export, defaults to all")
+    args = parser.parse_args()
+    if not EMBEDDING_SNAPSHOT_DIR:
+        parser.error("EMBEDDING_SNAPSHOT_DIR is empty, snapshots are disabled")
+
+    for document in args.documents:
+        started = time.perf_counter()
+        path = export_document_snapshot(document)
+        snapshot = open_snapshot(path)
+        print(f"{document}: {snapshot.count} embeddings of dimension {snapshot.dimension} as {snapshot.dtype}, "
+              f"{os.path.getsize(path) / 2 ** 20:.1f} MB, {time.perf_counter() - started:.2f}s -> {path}")
+
+if __name__ == "__main__":
+    main()
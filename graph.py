@@ -1,10 +1,9 @@
-import streamlit as st
-from langchain_community.graphs import Neo4jGraph
+from services import get_graph
 
-# Connect to Neo4j
+# Connect to Neo4j on first use, `from graph import graph` still works but opens the connection
+# at import time, prefer calling get_graph() where the connection is needed
 
-graph = Neo4jGraph(
-    url=st.secrets["NEO4J_URI"],
-    username=st.secrets["NEO4J_USERNAME"],
-    password=st.secrets["NEO4J_PASSWORD"],
-)
\ No newline at end of file
+def __getattr__(name):
+    if name == "graph":
+        return get_graph()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,240 @@
+"""
+    Chat history whose per-turn cost doesn't grow with the conversation.
+
+    Messages are stored as the chain Neo4jChatMessageHistory uses, (:Session)-[:LAST_MESSAGE]->(:Message)
+    with [:NEXT] links, plus a running index per message and a rolling summary on the session node:
+
+    - Reading returns the last HISTORY_WINDOW_TURNS turns verbatim, cut to HISTORY_TOKEN_BUDGET tokens,
+      preceded by the summary. Both come from one query that walks at most the window.
+    - Once a turn leaves the window it is folded into the summary by one LLM call, in the background,
+      so answering never waits for it. Each fold only reads the turns not summarized yet.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+from langchain_community.chat_message_histories import Neo4jChatMessageHistory
+from langchain_core.messages import SystemMessage, get_buffer_string, messages_from_dict
+
+from services import get_llm
+from tools.context import count_tokens, truncate_tokens
+from tracing import span
+
+HISTORY_WINDOW_TURNS = int(st.secrets.get("HISTORY_WINDOW_TURNS", 3))
+HISTORY_TOKEN_BUDGET = int(st.secrets.get("HISTORY_TOKEN_BUDGET", 1500))
+HISTORY_SUMMARY_ENABLED = bool(st.secrets.get("HISTORY_SUMMARY_ENABLED", True))
+HISTORY_SUMMARY_WORDS = int(st.secrets.get("HISTORY_SUMMARY_WORDS", 200))
+# A summary that fell behind catches up this many messages per fold, oldest first, until it is current
+MAX_FOLD_MESSAGES = 20
+# Answers are long tables, only their beginning goes into the summary prompt
+FOLD_MESSAGE_TOKENS = 400
+# Below this, a message that doesn't fit the budget is left out rather than cut
+MIN_TRUNCATED_TOKENS = 50
+
+SUMMARY_PROMPT = """Update the summary of a conversation between a user and an assistant answering questions about medical regulations.
+Keep the user's questions, the regulations, requirements, documents and page numbers discussed, and anything the user said about their situation.
+Answer with the updated summary only, in at most {words} words.
+
+Current summary:
+{summary}
+
+New lines of the conversation:
+{lines}
+
+Updated summary:"""
+
+_summarizer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+
+class WindowedChatHistory(Neo4jChatMessageHistory):
+    """
+    Neo4jChatMessageHistory that reads a token-budgeted window and a rolling summary, with its graph
+    reads and writes traced.
+
+    Parameters:
+    session_id (str): Id of the chat session.
+    graph (Neo4jGraph): Connection whose driver is used.
+    window_turns (int): Question/answer turns returned verbatim.
+    token_budget (int): Maximum tokens of the verbatim turns.
+    summarize (bool): Fold the turns leaving the window into the summary.
+    """
+
+    def __init__(self, session_id, graph, window_turns=None, token_budget=None, summarize=None, node_label="Session"):
+        # The parent constructor would create the session node with an extra query on every turn,
+        # the first message written creates it instead
+        if not session_id:
+            raise ValueError("Please ensure that the session_id parameter is provided")
+        self._driver = graph._driver
+        self._database = graph._database
+        self._session_id = session_id
+        self._node_label = node_label
+        self._window = window_turns or HISTORY_WINDOW_TURNS
+        self.token_budget = token_budget or HISTORY_TOKEN_BUDGET
+        self.summarize = HISTORY_SUMMARY_ENABLED if summarize is None else summarize
+
+    @property
+    def window_messages(self):
+        return self._window * 2
+
+    @property
+    def messages(self):
+        with span("neo4j.history_read") as record:
+            records, _, _ = self._driver.execute_query(
+                f"MATCH (s:`{self._node_label}`) WHERE s.id = $session_id "
+                "OPTIONAL MATCH (s)-[:LAST_MESSAGE]->(last_message) "
+                f"OPTIONAL MATCH p=(last_message)<-[:NEXT*0..{self.window_messages - 1}]-() "
+                "WITH s, p ORDER BY length(p) DESC LIMIT 1 "
+                "RETURN s.summary AS summary, "
+                "[node IN reverse(coalesce(nodes(p), [])) | {data: {content: node.content}, type: node.type}] AS messages",
+                {"session_id": self._session_id},
+            )
+            record["rows"] = len(records[0]["messages"]) if records else 0
+
+        if not records:
+            return []
+        messages = self._fit_budget(messages_from_dict(records[0]["messages"]))
+        if records[0]["summary"]:
+            messages.insert(0, SystemMessage(content=f"Summary of the earlier conversation: {records[0]['summary']}"))
+        return messages
+
+    @messages.setter
+    def messages(self, messages):
+        Neo4jChatMessageHistory.messages.fset(self, messages)
+
+    def _fit_budget(self, messages):
+        # The newest messages are kept first, the oldest one that only partly fits is cut
+        kept = []
+        remaining = self.token_budget
+        for message in reversed(messages):
+            tokens = count_tokens(message.content)
+            if tokens > remaining:
+                if remaining >= MIN_TRUNCATED_TOKENS:
+                    kept.append(message.copy(update={"content": truncate_tokens(message.content, remaining)}))
+                break
+            kept.append(message)
+            remaining -= tokens
+        return kept[::-1]
+
+    def add_message(self, message):
+        with span("neo4j.history_write", type=message.type):
+            records, _, _ = self._driver.execute_query(
+                f"MERGE (s:`{self._node_label}` {{id: $session_id}}) "
+                "WITH s "
+                "OPTIONAL MATCH (s)-[lm:LAST_MESSAGE]->(last_message) "
+                "SET s.message_count = coalesce(s.message_count, 0) + 1 "
+                "CREATE (s)-[:LAST_MESSAGE]->(new:Message) "
+                "SET new += {type: $type, content: $content, index: s.message_count} "
+                "WITH s, new, lm, last_message "
+                "FOREACH (_ IN CASE WHEN last_message IS NULL THEN [] ELSE [1] END | "
+                "CREATE (last_message)-[:NEXT]->(new)) "
+                "DELETE lm "
+                "RETURN s.message_count AS message_count, coalesce(s.summarized_count, 0) AS summarized_count",
+                {"type": message.type, "content": message.content, "session_id": self._session_id},
+            )
+
+        # A turn ends with the answer, fold what left the window
+        message_count, summarized_count = records[0]["message_count"], records[0]["summarized_count"]
+        if self.summarize and message.type == "ai" and message_count - summarized_count > self.window_messages:
+            self._schedule_fold()
+
+    def has_history(self):
+        """
+        Whether the session has messages or a summary that answers can depend on.
+        """
+        state = self._session_state()
+        return state is not None and bool(state["message_count"] or state["summary"])
+
+    def _session_state(self):
+        records, _, _ = self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}`) WHERE s.id = $session_id "
+            "RETURN s.message_count AS message_count, coalesce(s.summarized_count, 0) AS summarized_count, "
+            "s.summary AS summary",
+            {"session_id": self._session_id},
+        )
+        return records[0] if records else None
+
+    def clear(self):
+        super().clear()
+        self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}`) WHERE s.id = $session_id "
+            "REMOVE s.summary, s.summarized_count, s.message_count",
+            {"session_id": self._session_id},
+        )
+
+    def __del__(self):
+        # The driver is the app's shared one (see services.py), the parent would close it here
+        pass
+
+    def _schedule_fold(self):
+        with _summarizing_lock:
+            if self._session_id in _summarizing:
+                # The running fold, or the next turn's, catches up with these messages
+                return
+            _summarizing.add(self._session_id)
+        _summarizer.submit(self._fold)
+
+    def _fold(self):
+        backlog = 0
+        try:
+            with span("history.summarize") as record:
+                record["messages"], backlog = self._fold_pending()
+                record["backlog"] = backlog
+        except Exception as e:
+            print(f"Summarizing the chat history of session {self._session_id} failed: {e}")
+        finally:
+            with _summarizing_lock:
+                _summarizing.discard(self._session_id)
+        if backlog:
+            self._schedule_fold()
+
+    def _fold_pending(self):
+        # Returns the number of messages folded and of those still waiting for a later fold
+        state = self._session_state()
+        if state is None:
+            return 0, 0
+        message_count, summarized_count, summary = state["message_count"], state["summarized_count"], state["summary"]
+        pending_through = message_count - self.window_messages
+        if pending_through <= summarized_count:
+            return 0, 0
+        start = summarized_count
+        through = min(pending_through, start + MAX_FOLD_MESSAGES)
+
+        # Walks back from the last message only as far as the oldest message to fold
+        records, _, _ = self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}`)-[:LAST_MESSAGE]->(last_message) WHERE s.id = $session_id "
+            f"MATCH p=(last_message)<-[:NEXT*0..{message_count - start - 1}]-() "
+            "WITH p ORDER BY length(p) DESC LIMIT 1 "
+            "UNWIND nodes(p) AS node "
+            "WITH node WHERE node.index > $start AND node.index <= $through "
+            "RETURN node.type AS type, node.content AS content ORDER BY node.index",
+            {"session_id": self._session_id, "start": start, "through": through},
+        )
+        folded = messages_from_dict([{"type": r["type"], "data": {"content": r["content"]}} for r in records])
+
+        if folded:
+            for message in folded:
+                message.content = truncate_tokens(message.content, FOLD_MESSAGE_TOKENS)
+            summary = get_llm().invoke(SUMMARY_PROMPT.format(
+                words=HISTORY_SUMMARY_WORDS,
+                summary=summary or "None yet.",
+                lines=get_buffer_string(folded, human_prefix="User", ai_prefix="Assistant"),
+            )).content.strip()
+
+        # Only applied when no other process folded these messages in the meantime
+        self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}`) WHERE s.id = $session_id "
+            "AND coalesce(s.summarized_count, 0) = $summarized_count "
+            "SET s.summary = $summary, s.summarized_count = $through",
+            {"session_id": self._session_id, "summarized_count": summarized_count,
+             "summary": summary, "through": through},
+        )
+        return len(folded), pending_through - through
+
+
+def format_chat_history(messages):
+    """
+    Renders history messages as text for string prompts such as the ReAct agent's.
+    """
+    return get_buffer_string(messages, human_prefix="User", ai_prefix="Assistant") or "None"
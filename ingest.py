@@ -0,0 +1,98 @@
+"""
+    Batch ingestion of a whole directory of regulatory documents.
+
+    Each file goes through the staged pipeline in upload.py, several files are ingested at once.
+    This is what the scaling tests described in upload.py run: groups of 1, 5 and 50 documents.
+
+    Usage:
+    python ingest.py path/to/documents --concurrency 5
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from upload import ingest_file
+
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".txt")
+
+def find_documents(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith(SUPPORTED_EXTENSIONS)
+    )
+
+def ingest_directory(directory, concurrency=1, upload_to_s3=True, **pipeline_options):
+    """
+    Ingests every supported document of a directory with up to `concurrency` files in flight.
+
+    Returns:
+    dict: The per-file reports, the failures, the wall time and the summed per-stage timings.
+    """
+    file_paths = find_documents(directory)
+    reports = []
+    failures = {}
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {
+            executor.submit(ingest_file, file_path, upload_to_s3=upload_to_s3, **pipeline_options): file_path
+            for file_path in file_paths
+        }
+        for future in as_completed(futures):
+            try:
+                reports.append(future.result())
+            except Exception as e:
+                failures[futures[future]] = str(e)
+                print(f"Failed to ingest {futures[future]}: {e}")
+
+    stages = {}
+    for report in reports:
+        for stage, totals in report["stages"].items():
+            summed = stages.setdefault(stage, {"seconds": 0.0, "items": 0})
+            summed["seconds"] += totals["seconds"]
+            summed["items"] += totals["items"]
+
+    seconds = time.perf_counter() - started
+    chunks = sum(report["chunks"] for report in reports)
+    return {
+        "files": len(reports),
+        "failures": failures,
+        "chunks": chunks,
+        "embedded": sum(report["embedded"] for report in reports),
+        "deleted": sum(report["deleted"] for report in reports),
+        "seconds": seconds,
+        "chunks_per_second": chunks / seconds if seconds > 0 else 0.0,
+        "stages": stages,
+        "reports": reports,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a directory of regulatory documents into Neo4j.")
+    parser.add_argument("directory", help="Directory containing .pdf, .docx and .txt documents")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of files ingested at once")
+    parser.add_argument("--embed-workers", type=int, default=None, help="Embedding workers per file")
+    parser.add_argument("--group-size", type=int, default=None, help="Chunks passed between stages at a time")
+    parser.add_argument("--queue-size", type=int, default=None, help="Groups buffered between two stages")
+    parser.add_argument("--skip-s3", action="store_true", help="Do not upload the original files to S3")
+    args = parser.parse_args()
+
+    summary = ingest_directory(
+        args.directory,
+        concurrency=args.concurrency,
+        upload_to_s3=not args.skip_s3,
+        embed_workers=args.embed_workers,
+        group_size=args.group_size,
+        queue_size=args.queue_size,
+    )
+
+    print(f"\nIngested {summary['files']} files, {summary['chunks']} chunks ({summary['embedded']} embedded, "
+          f"{summary['deleted']} deleted) in {summary['seconds']:.2f}s "
+          f"({summary['chunks_per_second']:.1f} chunks/s), {len(summary['failures'])} failed")
+    print("Time spent per stage (summed over workers):")
+    for stage, totals in summary["stages"].items():
+        print(f"  {stage:<10} {totals['seconds']:8.2f}s  {totals['items']} items")
+
+if __name__ == "__main__":
+    main()
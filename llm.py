@@ -1,30 +1,11 @@
-import streamlit as st
+from services import get_embedding_model, get_llm
 
-# Create the LLM
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from sentence_transformers import SentenceTransformer
+# The LLM and the embedding model are created on first use (see services.py),
+# `from llm import llm, model` still works but creates them at import time
 
-llm = ChatOpenAI(
-    openai_api_key=st.secrets["OPENAI_API_KEY"],
-    model=st.secrets["OPENAI_MODEL"],
-)
-
-# Create the OpenAI Embedding model
-model = OpenAIEmbeddings(
-    openai_api_key=st.secrets["OPENAI_API_KEY"]
-)
-
-# # Replace the OpenAI Embeddings with sentence-transformers model
-# model = SentenceTransformer('sentence-transformers/msmarco-MiniLM-L-12-v3')
-
-# # Function to create embeddings
-# def create_embedding(content):
-#     return embeddings.embed_query(content)
-
-# Example usage with sentence-transformers
-# content = "This is an example sentence."
-# content_embedding = model.encode(content)
-
-# # Example usage with OpenAI
-# content = "This is an example sentence."
-# content_embedding = create_embedding(content)
+def __getattr__(name):
+    if name == "llm":
+        return get_llm()
+    if name == "model":
+        return get_embedding_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,278 @@
+"""
+    Asyncio query service in front of the agent and the document retrieval.
+
+    Front-ends submit questions to the service instead of calling the agent themselves; bot.py is
+    one of its clients. The service:
+
+    - Coalesces concurrent requests for the same normalized question onto one in-flight computation,
+      when they open their conversations: an answer written with one session's history isn't shared.
+      The answer is streamed to every client waiting for it, and recorded in each client's chat
+      history. Questions asked again after that computation finished are served by the answer cache.
+    - Runs at most QUERY_MAX_CONCURRENCY computations at a time. Up to QUERY_MAX_QUEUE more wait for
+      a free slot, further questions are rejected with ServiceOverloaded. Questions all of whose
+      clients gave up before a slot was free are dropped.
+    - Gives up on a request after its deadline, QUERY_TIMEOUT seconds by default, with
+      DeadlineExceeded. A computation other clients still wait for keeps running.
+
+    The computations are the repository's synchronous functions, run on a thread pool by an event
+    loop of their own, so synchronous callers like Streamlit scripts can use stream_answer().
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from agent import StreamingEventHandler, get_memory, respond
+from services import shared_resource
+from tools.vector import get_medic_docs
+from tracing import new_request_id, register_gauge
+
+QUERY_MAX_CONCURRENCY = int(st.secrets.get("QUERY_MAX_CONCURRENCY", 4))
+QUERY_MAX_QUEUE = int(st.secrets.get("QUERY_MAX_QUEUE", 32))
+QUERY_TIMEOUT = float(st.secrets.get("QUERY_TIMEOUT", 120))
+
+_END = object()
+
+
+class QueryServiceError(Exception):
+    """
+    A request the service couldn't answer, with a message meant for the user.
+    """
+
+
+class ServiceOverloaded(QueryServiceError):
+    pass
+
+
+class DeadlineExceeded(QueryServiceError):
+    pass
+
+
+def normalize_question(question):
+    """
+    Key under which requests are coalesced: case, whitespace and trailing punctuation are ignored.
+    """
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
+class _Flight:
+    # One in-flight computation and the clients waiting for it
+    def __init__(self, key, session_id):
+        self.key = key
+        self.session_id = session_id
+        self.request_id = new_request_id()
+        self.events = []  # replayed to clients joining late
+        self.subscribers = set()
+        self.task = None
+        self.started = False
+
+
+class QueryService:
+    """
+    Parameters:
+    max_concurrency (int): Computations running at the same time.
+    max_queue (int): Computations waiting for a free slot before requests are rejected.
+    timeout (float): Default deadline of a request, in seconds.
+    """
+
+    def __init__(self, max_concurrency=None, max_queue=None, timeout=None):
+        self.max_concurrency = max_concurrency or QUERY_MAX_CONCURRENCY
+        self.max_queue = QUERY_MAX_QUEUE if max_queue is None else max_queue
+        self.timeout = timeout or QUERY_TIMEOUT
+        self._flights = {}
+        self._running = 0
+        self._stats = {"requests": 0, "coalesced": 0, "rejected": 0, "deadline_exceeded": 0, "failed": 0}
+        # The pool also runs the history checks and writes of the clients, next to the computations
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency + 2, thread_name_prefix="query-service")
+        self._loop = asyncio.new_event_loop()
+        self._slots = None
+        threading.Thread(target=self._run_loop, name="query-service-loop", daemon=True).start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._loop.run_forever()
+
+    def stats(self):
+        return dict(self._stats, in_flight=len(self._flights), running=self._running,
+                    queued=len(self._flights) - self._running)
+
+    # Asyncio API, for clients running on the service's loop
+
+    async def answer_events(self, question, session_id, deadline=None):
+        """
+        Answers a question, yielding the events of agent.stream_response: "status" and "token" events,
+        then one "final" event with the complete answer, its request id and whether it was coalesced.
+        """
+        deadline = deadline or time.monotonic() + self.timeout
+        key = ("answer", normalize_question(question))
+        if await self._loop.run_in_executor(self._executor, self._has_history, session_id):
+            # The answer depends on this conversation, only the same session's requests share it
+            key += (session_id,)
+        flight, leader = self._join(key, session_id, lambda flight: self._answer(flight, question))
+
+        events = asyncio.Queue()
+        for event in flight.events:
+            events.put_nowait(event)
+        flight.subscribers.add(events)
+        try:
+            while True:
+                event = await self._next(events, deadline, flight)
+                if event is _END:
+                    break
+                yield event
+            # Raises the computation's error, if any
+            output = flight.task.result()
+        finally:
+            flight.subscribers.discard(events)
+
+        if not leader and session_id != flight.session_id:
+            await self._loop.run_in_executor(self._executor, self._record_history, session_id, question, output)
+        yield {"type": "final", "text": output, "request_id": flight.request_id, "coalesced": not leader}
+
+    async def retrieve(self, question, deadline=None):
+        """
+        Coalesced get_medic_docs: the relevant chunks of every document for a question.
+        """
+        deadline = deadline or time.monotonic() + self.timeout
+        key = ("retrieve", normalize_question(question))
+        flight, _ = self._join(key, None, lambda flight: get_medic_docs(question))
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            self._stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded("The documents took too long to search, please try again.")
+
+    # Synchronous API, for clients on other threads such as Streamlit scripts
+
+    def stream_answer(self, question, session_id, timeout=None):
+        """
+        Blocking counterpart of answer_events(), yielding the same events.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        events = queue.Queue()
+
+        async def pump():
+            try:
+                async for event in self.answer_events(question, session_id, deadline):
+                    events.put(event)
+            finally:
+                events.put(_END)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        while True:
+            event = events.get()
+            if event is _END:
+                break
+            yield event
+        future.result()
+
+    def retrieve_sync(self, question, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        return asyncio.run_coroutine_threadsafe(self.retrieve(question, deadline), self._loop).result()
+
+    # Coalescing and admission control
+
+    def _join(self, key, session_id, compute):
+        self._stats["requests"] += 1
+        flight = self._flights.get(key)
+        if flight is not None:
+            self._stats["coalesced"] += 1
+            return flight, False
+
+        if len(self._flights) >= self.max_concurrency + self.max_queue:
+            self._stats["rejected"] += 1
+            raise ServiceOverloaded("The assistant is handling too many questions right now, please try again in a moment.")
+
+        flight = _Flight(key, session_id)
+        flight.task = self._loop.create_task(self._execute(flight, compute))
+        flight.task.add_done_callback(lambda task: self._finish(flight))
+        self._flights[key] = flight
+        return flight, True
+
+    async def _execute(self, flight, compute):
+        async with self._slots:
+            if not flight.subscribers and flight.key[0] == "answer":
+                # Every client gave up while the question was queued
+                raise DeadlineExceeded("Abandoned before it started.")
+            flight.started = True
+            self._running += 1
+            try:
+                return await self._loop.run_in_executor(self._executor, compute, flight)
+            except Exception:
+                self._stats["failed"] += 1
+                raise
+            finally:
+                self._running -= 1
+
+    def _finish(self, flight):
+        # Later requests start a new computation, or are answered from the answer cache
+        self._flights.pop(flight.key, None)
+        if not flight.task.cancelled():
+            # Retrieves the error, clients that gave up don't
+            flight.task.exception()
+        self._publish(flight, _END)
+
+    async def _next(self, events, deadline, flight):
+        try:
+            return await asyncio.wait_for(events.get(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            self._stats["deadline_exceeded"] += 1
+            if flight.started:
+                raise DeadlineExceeded("The answer took too long, please try again.")
+            raise DeadlineExceeded("The assistant is busy and couldn't start on this question in time, please try again.")
+
+    def _publish(self, flight, event):
+        if event is not _END:
+            flight.events.append(event)
+        for subscriber in flight.subscribers:
+            subscriber.put_nowait(event)
+
+    # Run on the thread pool
+
+    def _answer(self, flight, question):
+        emit = _Emitter(self._loop, self._publish, flight)
+        return respond(
+            question,
+            flight.session_id,
+            callbacks=[StreamingEventHandler(emit)],
+            status=lambda text: emit.put(("status", text)),
+            request_id=flight.request_id,
+        )
+
+    def _has_history(self, session_id):
+        return get_memory(session_id).has_history()
+
+    def _record_history(self, session_id, question, output):
+        memory = get_memory(session_id)
+        memory.add_user_message(question)
+        memory.add_ai_message(output)
+
+
+class _Emitter:
+    # Queue-like sink for StreamingEventHandler, publishing its events on the service's loop
+    def __init__(self, loop, publish, flight):
+        self._loop = loop
+        self._publish = publish
+        self._flight = flight
+
+    def put(self, item):
+        kind, text = item
+        self._loop.call_soon_threadsafe(self._publish, self._flight, {"type": kind, "text": text})
+
+
+@shared_resource
+def get_query_service():
+    service = QueryService()
+    for name, description in [
+        ("in_flight", "Questions being computed or waiting for a slot."),
+        ("queued", "Computations waiting for a free slot."),
+        ("coalesced", "Requests served by another request's computation."),
+        ("rejected", "Requests rejected because the service was saturated."),
+        ("deadline_exceeded", "Requests that gave up after their deadline."),
+    ]:
+        register_gauge(f"medic_query_service_{name}", description, lambda name=name: service.stats()[name])
+    return service
@@ -0,0 +1,259 @@
+"""
+    Lazily created service clients, shared by the whole process.
+
+    Importing the app used to connect to Neo4j (twice), create a boto3 client and load the
+    embedding model before the first page was drawn. Each client is now built by its accessor
+    on first use and reused afterwards:
+
+    - get_graph() / get_driver(): the Neo4jGraph connection and its driver, used by retrieval,
+      the chat history and ingestion alike.
+    - get_llm(): the chat model.
+    - get_embedding_model(): the embedding backend selected in embeddings.py.
+    - get_s3_client(): the S3 client used by ingestion.
+
+    Resources are scoped to the process, not to a Streamlit session. Those created with
+    shared_resource are also kept in st.cache_resource, so the module reloads Streamlit does when
+    the source changes don't open another driver or load the indexes again.
+    The time spent creating each client is recorded as an "init.<name>" span of the request
+    that triggered it.
+
+    Neo4j queries go through neo4j_session(). Inside session_scope(), e.g. one request, the
+    queries of a thread share one session instead of each acquiring their own; pool_stats()
+    reports how much of the connection pool is in use.
+"""
+import contextvars
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+import streamlit as st
+
+from tracing import record_span, register_gauge
+
+
+class LazyResource:
+    """
+    Calls its factory on the first call only, also when several threads race for it.
+    With across_reloads, the instance is also kept in st.cache_resource.
+    """
+
+    def __init__(self, factory, across_reloads=False):
+        functools.update_wrapper(self, factory)
+        # Outside `streamlit run` st.cache_resource doesn't cache, the instance is kept here as well
+        self._cached_factory = st.cache_resource(show_spinner=False)(factory) if across_reloads else factory
+        self._instance = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    started = time.perf_counter()
+                    self._instance = self._cached_factory()
+                    self._loaded = True
+                    record_span(f"init.{self.__name__.removeprefix('get_')}", time.perf_counter() - started)
+        return self._instance
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def override(self, instance):
+        """
+        Uses the given instance instead of calling the factory, e.g. a local fake in the benchmarks.
+        """
+        with self._lock:
+            self._instance = instance
+            self._loaded = True
+
+    def reset(self):
+        with self._lock:
+            if hasattr(self._cached_factory, "clear"):
+                self._cached_factory.clear()
+            self._instance = None
+            self._loaded = False
+
+
+def lazy(factory):
+    """
+    Creates the instance on first use and keeps it for the lifetime of the module.
+    """
+    return LazyResource(factory)
+
+
+def shared_resource(factory):
+    """
+    Like lazy, and the instance is also kept across module reloads. For clients and caches whose
+    factory doesn't depend on code that may change while the app runs.
+    """
+    return LazyResource(factory, across_reloads=True)
+
+
+# Connection pool of the shared driver. Retrieval queries up to RETRIEVAL_MAX_WORKERS documents at once
+# per question, so the pool should hold about that many connections per concurrent user.
+NEO4J_MAX_POOL_SIZE = int(st.secrets.get("NEO4J_MAX_POOL_SIZE", 100))
+NEO4J_MAX_CONNECTION_LIFETIME = float(st.secrets.get("NEO4J_MAX_CONNECTION_LIFETIME", 3600))
+NEO4J_CONNECTION_ACQUISITION_TIMEOUT = float(st.secrets.get("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60))
+# Records fetched per round-trip, embedding fetches return thousands of rows
+NEO4J_FETCH_SIZE = int(st.secrets.get("NEO4J_FETCH_SIZE", 1000))
+
+
+@shared_resource
+def get_graph():
+    from langchain_community.graphs import Neo4jGraph
+
+    return Neo4jGraph(
+        url=st.secrets["NEO4J_URI"],
+        username=st.secrets["NEO4J_USERNAME"],
+        password=st.secrets["NEO4J_PASSWORD"],
+        # The schema is only needed to generate Cypher, which the app doesn't do
+        refresh_schema=False,
+        driver_config={
+            "max_connection_pool_size": NEO4J_MAX_POOL_SIZE,
+            "max_connection_lifetime": NEO4J_MAX_CONNECTION_LIFETIME,
+            "connection_acquisition_timeout": NEO4J_CONNECTION_ACQUISITION_TIMEOUT,
+            "fetch_size": NEO4J_FETCH_SIZE,
+        },
+    )
+
+
+def get_driver():
+    # A single driver and connection pool for the whole app
+    return get_graph()._driver
+
+
+class _ScopedSession:
+    def __init__(self):
+        self.thread = threading.get_ident()
+        self.session = None
+
+
+_scoped_session = contextvars.ContextVar("neo4j_session", default=None)
+_session_stats_lock = threading.Lock()
+_session_stats = {"opened": 0, "reused": 0, "open": 0, "peak_open": 0}
+
+
+def _open_session():
+    session = get_driver().session(database=get_graph()._database)
+    with _session_stats_lock:
+        _session_stats["opened"] += 1
+        _session_stats["open"] += 1
+        _session_stats["peak_open"] = max(_session_stats["peak_open"], _session_stats["open"])
+    return session
+
+
+def _close_session(session):
+    try:
+        session.close()
+    finally:
+        with _session_stats_lock:
+            _session_stats["open"] -= 1
+
+
+@contextmanager
+def session_scope():
+    """
+    Shares one session between the neo4j_session() blocks run in this context, opened on first use.
+    Sessions aren't thread-safe, so blocks run by other threads (e.g. a copied context) open their own.
+    """
+    scope = _scoped_session.get()
+    if scope is not None and scope.thread == threading.get_ident():
+        # Already inside a scope of this thread, its session is reused
+        yield
+        return
+    scope = _ScopedSession()
+    token = _scoped_session.set(scope)
+    try:
+        yield
+    finally:
+        _scoped_session.reset(token)
+        if scope.session is not None:
+            _close_session(scope.session)
+
+
+@contextmanager
+def neo4j_session():
+    """
+    A session of the shared driver, the one of the current session_scope() when there is one.
+    """
+    scope = _scoped_session.get()
+    if scope is not None and scope.thread == threading.get_ident():
+        if scope.session is None:
+            scope.session = _open_session()
+        else:
+            with _session_stats_lock:
+                _session_stats["reused"] += 1
+        yield scope.session
+        return
+
+    session = _open_session()
+    try:
+        yield session
+    finally:
+        _close_session(session)
+
+
+def pool_stats():
+    """
+    Utilization of the Neo4j connection pool and of the sessions opened through neo4j_session().
+    """
+    with _session_stats_lock:
+        stats = {f"sessions_{key}": value for key, value in _session_stats.items()}
+    stats["max_pool_size"] = NEO4J_MAX_POOL_SIZE
+    if not get_graph.loaded:
+        return stats
+
+    # The driver has no public pool metrics, read them from its pool where it has one
+    pool = getattr(get_driver(), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is not None:
+        with pool.lock:
+            all_connections = [connection for queue in connections.values() for connection in queue]
+            stats["connections"] = len(all_connections)
+            stats["connections_in_use"] = sum(1 for connection in all_connections if connection.in_use)
+        stats["connections_idle"] = stats["connections"] - stats["connections_in_use"]
+        stats["utilization"] = stats["connections_in_use"] / NEO4J_MAX_POOL_SIZE
+    return stats
+
+
+register_gauge("medic_neo4j_sessions_open", "Neo4j sessions currently open.", lambda: pool_stats()["sessions_open"])
+register_gauge("medic_neo4j_connections_in_use", "Neo4j pool connections in use.",
+               lambda: pool_stats().get("connections_in_use"))
+register_gauge("medic_neo4j_connections", "Neo4j pool connections open.", lambda: pool_stats().get("connections"))
+register_gauge("medic_neo4j_max_pool_size", "Configured Neo4j pool size.", lambda: NEO4J_MAX_POOL_SIZE)
+
+
+@shared_resource
+def get_llm():
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(
+        openai_api_key=st.secrets["OPENAI_API_KEY"],
+        model=st.secrets["OPENAI_MODEL"],
+        # Stream tokens so answers can be rendered while they are generated
+        streaming=True,
+        # Streamed responses only report their token usage when asked to, in a final chunk
+        model_kwargs={"stream_options": {"include_usage": True}},
+    )
+
+
+@shared_resource
+def get_embedding_model():
+    from embeddings import create_embedding_backend
+
+    # OpenAI by default or a local sentence-transformers model when EMBEDDING_BACKEND = "local"
+    return create_embedding_backend()
+
+
+@shared_resource
+def get_s3_client():
+    import boto3
+
+    return boto3.client(
+        's3',
+        aws_access_key_id=st.secrets['AWS_ACCESS_KEY'],
+        aws_secret_access_key=st.secrets['AWS_SECRET_KEY'],
+        region_name=st.secrets['AWS_REGION']
+    )
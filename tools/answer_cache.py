@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Cache of previous answers looked up by cosine similarity of the query embedding.
+
+    Every entry remembers the corpus version it was answered from; a lookup with a different
+    version (a document was re-ingested) clears the cache.
+
+    Parameters:
+    threshold (float): Minimum cosine similarity for a cached answer to be reused.
+    ttl (float): Seconds an answer stays valid.
+    max_entries (int): Maximum number of answers, the least recently used one is evicted first.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600.0, max_entries=512):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Best similarity of recent lookups, to see where the threshold cuts
+        self.similarities = deque(maxlen=1000)
+        self._lock = threading.Lock()
+        self._corpus_version = None
+        self._clear()
+
+    def lookup(self, embedding, corpus_version):
+        """
+        Returns the cached answer of the most similar previous query, or None.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._check_version(corpus_version)
+            self._expire()
+
+            if not self._answers:
+                self.misses += 1
+                return None
+
+            similarities = self._embeddings @ query
+            best = int(np.argmax(similarities))
+            self.similarities.append(float(similarities[best]))
+
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._last_used[best] = time.monotonic()
+            return self._answers[best]
+
+    def put(self, embedding, answer, corpus_version):
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(corpus_version)
+            if len(self._answers) >= self.max_entries:
+                self._remove([int(np.argmin(self._last_used))])
+
+            self._embeddings = np.vstack([self._embeddings, query[None, :]]) if self._answers else query[None, :]
+            self._answers.append(answer)
+            self._created_at = np.append(self._created_at, now)
+            self._last_used = np.append(self._last_used, now)
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        similarities = np.array(self.similarities) if self.similarities else None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._answers),
+            "threshold": self.threshold,
+            "similarity_p50": float(np.percentile(similarities, 50)) if similarities is not None else None,
+            "similarity_p90": float(np.percentile(similarities, 90)) if similarities is not None else None,
+        }
+
+    def _check_version(self, corpus_version):
+        if corpus_version != self._corpus_version:
+            self._clear()
+            self._corpus_version = corpus_version
+
+    def _expire(self):
+        expired = np.flatnonzero(time.monotonic() - self._created_at > self.ttl)
+        if expired.size:
+            self._remove(expired.tolist())
+
+    def _remove(self, positions):
+        keep = np.setdiff1d(np.arange(len(self._answers)), positions)
+        self._embeddings = self._embeddings[keep]
+        self._answers = [self._answers[i] for i in keep]
+        self._created_at = self._created_at[keep]
+        self._last_used = self._last_used[keep]
+
+    def _clear(self):
+        self._embeddings = np.empty((0, 0), dtype=np.float32)
+        self._answers = []
+        self._created_at = np.empty(0)
+        self._last_used = np.empty(0)
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
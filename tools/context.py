@@ -0,0 +1,91 @@
+import hashlib
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken missing, or its encoding can't be downloaded on an offline host
+    _encoding = None
+
+
+def count_tokens(text):
+    """
+    Counts tokens with the OpenAI tokenizer, or estimates them at 4 characters per token without tiktoken.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def truncate_tokens(text, max_tokens):
+    """
+    Cuts text down to at most max_tokens tokens.
+    """
+    if _encoding is not None:
+        tokens = _encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else _encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 4]
+
+
+def chunk_key(chunk):
+    content_hash = hashlib.sha1((chunk['content'] or "").encode("utf-8")).hexdigest()
+    return chunk['filename'], chunk['page_number'], content_hash
+
+
+def build_context(hits, entity_details, token_budget=3000):
+    """
+    Packs the retrieved entities and chunks into a token-budgeted context.
+
+    Chunks mentioned by several hit entities, or found from several documents, appear once and are
+    ranked by the best distance of the hits that reached them. Items are added in rank order while
+    they fit in the budget.
+
+    Parameters:
+    hits (list): (entity name, distance) pairs, possibly from several documents.
+    entity_details (dict): entity name -> {"descriptions": ..., "connected_chunk_details": [...]}.
+    token_budget (int): Maximum number of tokens of the context.
+
+    Returns:
+    tuple: (context string, metadata with one entry per (document, page) packed into the context)
+    """
+    best_distance = {}
+    for entity_name, distance in hits:
+        if entity_name in entity_details:
+            best_distance[entity_name] = min(distance, best_distance.get(entity_name, distance))
+
+    # (rank distance, kind, key, text, chunk)
+    items = []
+    chunks = {}
+    for entity_name, distance in best_distance.items():
+        details = entity_details[entity_name]
+        items.append((distance, 0, entity_name, f"Entity: {entity_name}\nDescription: {details['descriptions']}", None))
+        for chunk in details['connected_chunk_details']:
+            key = chunk_key(chunk)
+            if key not in chunks or distance < chunks[key][0]:
+                chunks[key] = (distance, chunk)
+
+    for key, (distance, chunk) in chunks.items():
+        text = f"Chunk Content (document: {chunk['filename']}, page: {chunk['page_number']}): {chunk['content']}"
+        items.append((distance, 1, key, text, chunk))
+
+    items.sort(key=lambda item: (item[0], item[1]))
+
+    packed = []
+    pages = {}
+    used_tokens = 0
+    for distance, _, _, text, chunk in items:
+        tokens = count_tokens(text)
+        if used_tokens + tokens > token_budget:
+            # Smaller items further down may still fit
+            continue
+        packed.append(text)
+        used_tokens += tokens
+        if chunk is not None:
+            page = (chunk['filename'], chunk['page_number'])
+            pages[page] = min(distance, pages.get(page, distance))
+
+    metadata = [
+        {"document_name": document_name, "page_number": page_number, "distance": distance}
+        for (document_name, page_number), distance in sorted(pages.items(), key=lambda page: page[1])
+    ]
+    return "\n".join(packed), metadata
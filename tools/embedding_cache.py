@@ -0,0 +1,118 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_text(text):
+    """
+    Normalizes a query so trivially different wordings (case, whitespace) share a cache entry.
+    """
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache for query embeddings: a bounded in-memory LRU backed by a sqlite store.
+
+    Entries are keyed by (model id, sha256 of the normalized text) and stored as float32 bytes,
+    so repeated questions skip the embedding round-trip across sessions and restarts.
+
+    Parameters:
+    model_id (str): Identifier of the embedding model, part of every key.
+    max_entries (int): Maximum number of embeddings kept in memory.
+    path (str): Path of the sqlite file, or None to disable the on-disk tier.
+    """
+
+    def __init__(self, model_id, max_entries=1024, path=None):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model_id TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model_id, text_hash)
+                )
+            """)
+            self._db.commit()
+
+    def key(self, text):
+        return self.model_id, hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        """
+        Returns the cached embedding as a float32 array, or None on a miss.
+        """
+        key = self.key(text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding FROM embeddings WHERE model_id = ? AND text_hash = ?", key
+                ).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, embedding)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, text, embedding):
+        key = self.key(text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, embedding)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (model_id, text_hash, embedding) VALUES (?, ?, ?)",
+                    (*key, embedding.tobytes()),
+                )
+                self._db.commit()
+        return embedding
+
+    def get_or_compute(self, text, compute):
+        embedding = self.get(text)
+        if embedding is None:
+            embedding = self.put(text, compute(text))
+        return embedding
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _remember(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
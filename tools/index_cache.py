@@ -0,0 +1,158 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+
+
+class CachedIndex:
+    """
+    A FAISS index built for a single document together with the entity ids
+    (in index order) and the document version it was built from.
+    """
+
+    def __init__(self, index, ids, version):
+        self.index = index
+        self.ids = ids
+        self.version = version
+        self.checked_at = time.monotonic()
+
+
+class FaissIndexCache:
+    """
+    Process-wide cache of per-document FAISS indexes.
+
+    Parameters:
+    loader (callable): loader(document_name, version) -> (index, ids), builds the index of that document version.
+        The index is a faiss.Index, or any object with the same search() interface, which isn't persisted.
+    version_fetcher (callable): version_fetcher(document_name) -> str, the document fingerprint stored in Neo4j.
+    cache_dir (str): Optional directory where indexes are persisted with faiss.write_index/read_index.
+    check_interval (float): Seconds during which a cached index is trusted without re-reading its version.
+    prepare (callable): Optional prepare(index) applied to indexes read from disk, e.g. to restore search parameters.
+    variant (str): Optional description of how the loader builds indexes, e.g. the index type and its parameters.
+        It is part of the file names, so indexes persisted with another configuration are never read back.
+    """
+
+    def __init__(self, loader, version_fetcher, cache_dir=None, check_interval=30.0, prepare=None, variant=None):
+        self._loader = loader
+        self._variant = variant
+        self._prepare = prepare
+        self._version_fetcher = version_fetcher
+        self._cache_dir = cache_dir
+        self._check_interval = check_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._document_locks = {}
+        self._rebuilds = {}
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="faiss-rebuild")
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, document_name):
+        """
+        Returns the CachedIndex for a document, or None when the document has no embeddings.
+        The index is (re)built only when missing or when its version no longer matches Neo4j.
+        """
+        entry = self._entries.get(document_name)
+        if entry is not None and time.monotonic() - entry.checked_at < self._check_interval:
+            return entry
+
+        version = self._version_fetcher(document_name)
+        if entry is not None and entry.version == version:
+            entry.checked_at = time.monotonic()
+            return entry
+
+        with self._document_lock(document_name):
+            # Another thread may have rebuilt the index while we were waiting
+            entry = self._entries.get(document_name)
+            if entry is not None and entry.version == version:
+                entry.checked_at = time.monotonic()
+                return entry
+            return self._build(document_name, version)
+
+    def invalidate(self, document_name=None):
+        """
+        Drops the in-memory and on-disk index for a document, or for all documents.
+        """
+        with self._lock:
+            names = [document_name] if document_name else list(self._entries)
+            for name in names:
+                self._entries.pop(name, None)
+        for name in names:
+            for path in self._disk_paths(name):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def refresh_async(self, document_name):
+        """
+        Rebuilds the index for a document in the background, e.g. after ingestion changed it.
+        Queries keep using the previous index until the new one is ready.
+        """
+        with self._lock:
+            pending = self._rebuilds.get(document_name)
+            if pending is not None and not pending.done():
+                return pending
+            future = self._executor.submit(self._refresh, document_name)
+            self._rebuilds[document_name] = future
+            return future
+
+    def _refresh(self, document_name):
+        version = self._version_fetcher(document_name)
+        with self._document_lock(document_name):
+            return self._build(document_name, version)
+
+    def _document_lock(self, document_name):
+        with self._lock:
+            return self._document_locks.setdefault(document_name, threading.Lock())
+
+    def _build(self, document_name, version):
+        entry = self._load_from_disk(document_name, version)
+        if entry is None:
+            index, ids = self._loader(document_name, version)
+            if index is None:
+                with self._lock:
+                    self._entries.pop(document_name, None)
+                return None
+            entry = CachedIndex(index, ids, version)
+            self._save_to_disk(document_name, entry)
+
+        with self._lock:
+            self._entries[document_name] = entry
+        return entry
+
+    def _disk_paths(self, document_name):
+        if not self._cache_dir:
+            return None, None
+        safe_name = re.sub(r"[^A-Za-z0-9._-]", "_", document_name)
+        if self._variant:
+            safe_name += "." + re.sub(r"[^A-Za-z0-9._-]", "_", self._variant)
+        base = os.path.join(self._cache_dir, safe_name)
+        return base + ".faiss", base + ".json"
+
+    def _load_from_disk(self, document_name, version):
+        index_path, meta_path = self._disk_paths(document_name)
+        if not index_path or not os.path.exists(index_path) or not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != version or meta.get("variant") != self._variant:
+            return None
+        index = faiss.read_index(index_path)
+        if self._prepare is not None:
+            index = self._prepare(index)
+        return CachedIndex(index, meta["ids"], version)
+
+    def _save_to_disk(self, document_name, entry):
+        index_path, meta_path = self._disk_paths(document_name)
+        if not index_path or not isinstance(entry.index, faiss.Index):
+            return
+        # Write to temporary files first so a concurrent reader never sees a partial index
+        faiss.write_index(entry.index, index_path + ".tmp")
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({"version": entry.version, "variant": self._variant, "ids": entry.ids}, f)
+        os.replace(index_path + ".tmp", index_path)
+        os.replace(meta_path + ".tmp", meta_path)
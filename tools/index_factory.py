@@ -0,0 +1,86 @@
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+
+def default_nlist(count):
+    # Rule of thumb: about sqrt(N) lists, with enough training points per list
+    return max(1, min(int(np.sqrt(count)), count // 39 or 1))
+
+
+def default_pq_m(dimension):
+    # Number of sub-quantizers, must divide the dimension
+    for m in (64, 48, 32, 24, 16, 8, 4, 2, 1):
+        if dimension % m == 0 and m <= dimension:
+            return m
+    return 1
+
+
+def build_index(embeddings, index_type="flat", nlist=None, pq_m=None, pq_bits=8,
+                hnsw_m=32, ef_construction=80, nprobe=8, ef_search=64):
+    """
+    Builds a FAISS index of the requested type over float32 embeddings, training it when needed.
+
+    Parameters:
+    embeddings (np.ndarray): (N, d) float32 matrix.
+    index_type (str): One of "flat" (exact), "ivf_flat", "hnsw" or "ivf_pq".
+    nlist (int): Number of inverted lists for the IVF types, defaults to about sqrt(N).
+    pq_m (int): Number of product-quantizer sub-vectors for "ivf_pq", must divide d.
+    pq_bits (int): Bits per sub-vector code for "ivf_pq".
+    hnsw_m (int): Neighbours per node for "hnsw".
+    ef_construction (int): Build-time search depth for "hnsw".
+    nprobe (int): Lists visited per query for the IVF types.
+    ef_search (int): Query-time search depth for "hnsw".
+
+    Returns:
+    faiss.Index: The populated index, using L2 distances like IndexFlatL2.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    count, dimension = embeddings.shape
+
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}")
+
+    # Approximate indexes need enough points to train; small documents are searched exactly
+    if index_type == "ivf_pq" and count < 39 * 2 ** pq_bits:
+        index_type = "flat"
+    if index_type in ("ivf_flat", "ivf_pq") and count < 39:
+        index_type = "flat"
+
+    if index_type == "flat":
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        nlist = min(nlist or default_nlist(count), count)
+        quantizer = faiss.IndexFlatL2(dimension)
+        if index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dimension, nlist)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m or default_pq_m(dimension), pq_bits)
+        index.train(embeddings)
+
+    index.add(embeddings)
+    configure_search(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+
+def configure_search(index, nprobe=8, ef_search=64):
+    """
+    Applies the query-time parameters, which faiss.read_index does not restore.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def index_memory_bytes(index):
+    """
+    Size of the serialized index, a close estimate of the memory it holds.
+    """
+    return int(faiss.serialize_index(index).nbytes)
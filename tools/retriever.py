@@ -0,0 +1,245 @@
+import time
+from collections import namedtuple
+
+from services import neo4j_session
+from tracing import record_span, span
+
+# hits: document -> [(entity name, squared L2 distance)] nearest first,
+# entity_details: entity name -> {"descriptions": ..., "connected_chunk_details": [...]},
+# timed_out: documents left out, transferred_bytes: estimated size of what was read from Neo4j for the query
+Retrieval = namedtuple("Retrieval", ["hits", "entity_details", "timed_out", "transferred_bytes"])
+
+
+def payload_bytes(value):
+    """
+    Rough size of a value as received from Neo4j: 8 bytes per number, the UTF-8 length of strings.
+    """
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, dict):
+        return sum(len(key) + payload_bytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(payload_bytes(item) for item in value)
+    return 8
+
+
+class Retriever:
+    """
+    Finds the entities nearest to a query embedding in every document, with their chunks.
+    tools.vector.search_documents builds the per-document and merged contexts from the result.
+    """
+
+    name = None
+
+    def retrieve(self, query_embedding, documents, top_k, timeout):
+        """
+        Parameters:
+        query_embedding (np.ndarray): (1, d) float32 query embedding.
+        documents (list): File names of the documents to search.
+        top_k (int): Hits per document.
+        timeout (float): Seconds the search may take.
+
+        Returns:
+        Retrieval
+        """
+        raise NotImplementedError
+
+
+# Converts the index's similarity score back to the squared L2 distance the FAISS path returns,
+# so both backends rank and merge the same way. Neo4j reports euclidean as 1 / (1 + d²) and
+# cosine as (1 + cos) / 2, which is 1 - d² / 4 for normalized vectors.
+SCORE_TO_DISTANCE = {
+    "euclidean": lambda score: 1.0 / score - 1.0 if score > 0 else float("inf"),
+    "cosine": lambda score: 4.0 * (1.0 - score),
+}
+
+VECTOR_SEARCH_QUERY = """
+CALL db.index.vector.queryNodes($index_name, $candidates, $embedding) YIELD node, score
+WHERE node.file_name IN $documents
+WITH node.file_name AS document, node, score
+ORDER BY score DESC
+WITH document, collect({node: node, score: score})[..$top_k] AS hits
+UNWIND hits AS hit
+WITH document, hit.node AS e, hit.score AS score
+OPTIONAL MATCH (e)-[:MENTIONS]-(chunk:Chunk)
+WITH document, e, score, collect({
+    content: chunk.content,
+    page_number: chunk.page_number,
+    filename: chunk.file_name
+}) AS connected_chunk_details
+RETURN document, e.name AS entity_name, score, e.descriptions AS descriptions, connected_chunk_details
+ORDER BY document, score DESC
+"""
+
+
+class Neo4jVectorRetriever(Retriever):
+    """
+    Searches Neo4j's native vector index on the entity embeddings: the nearest entities and their
+    chunks come back from one query, and no embedding leaves the database.
+
+    The index spans all documents and can't be filtered before the search, so it is asked for
+    top_k * documents * oversample candidates which are then filtered on file_name. A document
+    whose entities rank poorly against the rest of the corpus may get fewer than top_k hits.
+
+    Parameters:
+    index_name (str): Name of the vector index, see ensure_vector_index().
+    similarity (str): The index's similarity function, "euclidean" or "cosine".
+    oversample (int): Candidates requested per expected hit.
+    """
+
+    name = "neo4j"
+
+    def __init__(self, index_name, similarity="euclidean", oversample=4):
+        self.index_name = index_name
+        self.to_distance = SCORE_TO_DISTANCE[similarity]
+        self.oversample = oversample
+
+    def retrieve(self, query_embedding, documents, top_k, timeout):
+        from neo4j import Query
+        from neo4j.exceptions import Neo4jError
+
+        candidates = top_k * len(documents) * self.oversample
+        with span("neo4j.vector_search", index=self.index_name, candidates=candidates) as record, \
+                neo4j_session() as session:
+            # The server stops the query at the deadline, like the FAISS path's per-document timeout
+            try:
+                records = list(session.run(
+                    Query(VECTOR_SEARCH_QUERY, timeout=timeout),
+                    index_name=self.index_name,
+                    candidates=candidates,
+                    embedding=query_embedding[0].tolist(),
+                    documents=list(documents),
+                    top_k=top_k,
+                ))
+            except Neo4jError as e:
+                if "TransactionTimedOut" not in (e.code or ""):
+                    raise
+                # One query searches every document, none of them made it in time
+                record["timed_out"] = True
+                print(f"Vector index search timed out after {timeout}s")
+                return Retrieval({}, {}, list(documents), 0)
+            record["rows"] = len(records)
+
+        hits = {}
+        entity_details = {}
+        transferred = 0
+        for row in records:
+            hits.setdefault(row["document"], []).append((row["entity_name"], self.to_distance(row["score"])))
+            entity_details.setdefault(row["entity_name"], {
+                "descriptions": row["descriptions"],
+                "connected_chunk_details": row["connected_chunk_details"],
+            })
+            transferred += payload_bytes(dict(row))
+        return Retrieval(hits, entity_details, [], transferred)
+
+
+class ComparingRetriever(Retriever):
+    """
+    Runs two retrievers on every query and returns the first one's result. Logs and traces
+    the latency, the transferred size and the overlap of their hits. A failing candidate is
+    logged and traced without affecting the answer.
+    """
+
+    name = "compare"
+
+    def __init__(self, primary, candidate):
+        self.primary = primary
+        self.candidate = candidate
+
+    def retrieve(self, query_embedding, documents, top_k, timeout):
+        timings = {}
+        results = {}
+        for retriever in (self.primary, self.candidate):
+            started = time.perf_counter()
+            try:
+                results[retriever.name] = retriever.retrieve(query_embedding, documents, top_k, timeout)
+            except Exception as e:
+                if retriever is self.primary:
+                    raise
+                record_span("retrieval.compare", time.perf_counter() - started, {f"{retriever.name}_error": str(e)})
+                print(f"{retriever.name} retrieval failed, comparison skipped: {e}")
+                return results[self.primary.name]
+            timings[retriever.name] = time.perf_counter() - started
+
+        primary, candidate = results[self.primary.name], results[self.candidate.name]
+        primary_hits = {(document, name) for document, hits in primary.hits.items() for name, _ in hits}
+        candidate_hits = {(document, name) for document, hits in candidate.hits.items() for name, _ in hits}
+        overlap = len(primary_hits & candidate_hits) / len(primary_hits) if primary_hits else 1.0
+
+        with span("retrieval.compare") as record:
+            for name, result in results.items():
+                record[f"{name}_ms"] = round(timings[name] * 1000, 2)
+                record[f"{name}_bytes"] = result.transferred_bytes
+            record["overlap"] = round(overlap, 3)
+        print(", ".join(
+            f"{name}: {timings[name] * 1000:.1f} ms, {result.transferred_bytes / 1024:.1f} KB"
+            for name, result in results.items()
+        ) + f", hit overlap {overlap:.0%}")
+        return primary
+
+
+def fetch_vector_index(session, index_name):
+    record = session.run(
+        "SHOW VECTOR INDEXES YIELD name, labelsOrTypes, properties, options "
+        "WHERE name = $index_name RETURN labelsOrTypes, properties, options",
+        index_name=index_name,
+    ).single()
+    if record is None:
+        return None
+    config = (record["options"] or {}).get("indexConfig", {})
+    return {
+        "label": (record["labelsOrTypes"] or [None])[0],
+        "property": (record["properties"] or [None])[0],
+        "dimensions": config.get("vector.dimensions"),
+        "similarity": config.get("vector.similarity_function"),
+    }
+
+
+def ensure_vector_index(index_name, dimension, similarity="euclidean", recreate=False):
+    """
+    Creates the vector index on the entity embeddings unless it exists, and checks that the index,
+    the stored embeddings and the query embedding model agree on the dimension.
+
+    Parameters:
+    index_name (str): Name of the index.
+    dimension (int): Dimension of the query embedding model.
+    similarity (str): "euclidean" or "cosine".
+    recreate (bool): Drop and create an existing index with another dimension or similarity.
+
+    Returns:
+    dict: The index's label, property, dimensions and similarity.
+    """
+    with neo4j_session() as session:
+        stored = session.run(
+            "MATCH (e:Entity) WHERE e.embedding IS NOT NULL RETURN size(e.embedding) AS dimension LIMIT 1"
+        ).single()
+        if stored is not None and stored["dimension"] != dimension:
+            # An index can't fix this, the entities have to be embedded again with the query model
+            raise ValueError(
+                f"Entity embeddings have dimension {stored['dimension']}, "
+                f"the query embedding model produces {dimension}"
+            )
+
+        existing = fetch_vector_index(session, index_name)
+        if existing is not None:
+            matches = existing["dimensions"] == dimension and (existing["similarity"] or "").lower() == similarity
+            if matches:
+                return existing
+            if not recreate:
+                raise ValueError(
+                    f"Vector index {index_name} has dimension {existing['dimensions']} and "
+                    f"{existing['similarity']} similarity, expected {dimension} and {similarity}. "
+                    "Recreate it with `python vectorIndex.py --recreate`"
+                )
+            session.run(f"DROP INDEX `{index_name}` IF EXISTS")
+
+        session.run(
+            f"CREATE VECTOR INDEX `{index_name}` IF NOT EXISTS "
+            "FOR (e:Entity) ON e.embedding "
+            "OPTIONS {indexConfig: {`vector.dimensions`: $dimension, `vector.similarity_function`: $similarity}}",
+            dimension=dimension,
+            similarity=similarity,
+        )
+        return fetch_vector_index(session, index_name)
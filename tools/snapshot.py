@@ -0,0 +1,249 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b"MEDEMB01"
+DTYPES = ("float32", "float16", "int8")
+# Offset of the vectors: the magic and the footer offset
+DATA_OFFSET = len(MAGIC) + 8
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class SnapshotWriter:
+    """
+    Streams embeddings into a compact snapshot file, one row at a time.
+
+    The file holds the contiguous (N, d) vectors as float32, float16 or int8, an int8 scale per
+    row, the squared norm of every stored row and a JSON footer with the model, the dimension,
+    the document version and the id of every row. Rows are written as they arrive, so exporting
+    never holds the whole matrix in memory. The file only replaces an existing snapshot once complete.
+
+    Parameters:
+    path (str): Path of the snapshot file.
+    dtype (str): "float32", "float16" or "int8" (symmetric per-row quantization).
+    model_id (str): Identifier of the embedding model the vectors come from.
+    version (str): Version of the document the vectors were exported from.
+    """
+
+    def __init__(self, path, dtype="float32", model_id=None, version=None):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported snapshot dtype: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.model_id = model_id
+        self.version = version
+        self.dimension = None
+        self.ids = []
+        self._scales = []
+        self._norms = []
+        # Unique per writer, processes exporting the same document don't write into each other's file
+        self._tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(MAGIC + struct.pack("<Q", 0))
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def append(self, vector, id):
+        vector = np.asarray(vector, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = vector.shape[0]
+        elif vector.shape[0] != self.dimension:
+            raise ValueError(f"Embedding of {id} has dimension {vector.shape[0]}, expected {self.dimension}")
+
+        if self.dtype == "int8":
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            stored = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+            decoded = stored.astype(np.float32) * scale
+            self._scales.append(scale)
+        else:
+            stored = vector.astype(self.dtype)
+            decoded = stored.astype(np.float32)
+
+        self._file.write(stored.tobytes())
+        # Norms of the stored values, so distances are exact for the decoded vectors
+        self._norms.append(float(np.dot(decoded, decoded)))
+        self.ids.append(id)
+
+    def close(self):
+        offset = self._file.tell()
+        scales_offset = None
+        if self.dtype == "int8":
+            scales_offset = self._pad(offset)
+            self._file.write(np.asarray(self._scales, dtype=np.float32).tobytes())
+            offset = self._file.tell()
+        norms_offset = self._pad(offset)
+        self._file.write(np.asarray(self._norms, dtype=np.float32).tobytes())
+
+        footer_offset = self._file.tell()
+        self._file.write(json.dumps({
+            "model_id": self.model_id,
+            "dimension": self.dimension or 0,
+            "count": self.count,
+            "dtype": self.dtype,
+            "version": self.version,
+            "scales_offset": scales_offset,
+            "norms_offset": norms_offset,
+            "ids": self.ids,
+        }).encode("utf-8"))
+        self._file.seek(len(MAGIC))
+        self._file.write(struct.pack("<Q", footer_offset))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+    def _pad(self, offset):
+        aligned = _align(offset)
+        self._file.write(b"\0" * (aligned - offset))
+        return aligned
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def write_snapshot(path, embeddings, ids, dtype="float32", model_id=None, version=None):
+    with SnapshotWriter(path, dtype=dtype, model_id=model_id, version=version) as writer:
+        for vector, id in zip(embeddings, ids):
+            writer.append(vector, id)
+    return path
+
+
+class EmbeddingSnapshot:
+    """
+    A snapshot file memory-mapped read-only. The vectors aren't copied: processes opening the
+    same file share the operating system's page-cached copy.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(DATA_OFFSET)
+            if len(header) != DATA_OFFSET or header[:len(MAGIC)] != MAGIC:
+                raise ValueError(f"Not an embedding snapshot: {path}")
+            footer_offset, = struct.unpack("<Q", header[len(MAGIC):])
+            f.seek(footer_offset)
+            footer = json.loads(f.read().decode("utf-8"))
+
+        self.model_id = footer["model_id"]
+        self.dimension = footer["dimension"]
+        self.count = footer["count"]
+        self.dtype = footer["dtype"]
+        self.version = footer["version"]
+        self.ids = footer["ids"]
+
+        if self.count == 0:
+            self.matrix = np.empty((0, self.dimension), dtype=self.dtype)
+            self.scales = None
+            self.norms = np.empty(0, dtype=np.float32)
+            return
+
+        buffer = np.memmap(path, dtype=np.uint8, mode="r", shape=(footer_offset,))
+        matrix_bytes = self.count * self.dimension * np.dtype(self.dtype).itemsize
+        self.matrix = buffer[DATA_OFFSET:DATA_OFFSET + matrix_bytes].view(self.dtype).reshape(self.count, self.dimension)
+        self.scales = None
+        if footer["scales_offset"] is not None:
+            offset = footer["scales_offset"]
+            self.scales = buffer[offset:offset + self.count * 4].view(np.float32)
+        offset = footer["norms_offset"]
+        self.norms = buffer[offset:offset + self.count * 4].view(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes + self.norms.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def rows(self, start, stop):
+        """
+        Decodes rows [start, stop) to float32.
+        """
+        block = np.asarray(self.matrix[start:stop], dtype=np.float32)
+        if self.scales is not None:
+            block = block * self.scales[start:stop, None]
+        return block
+
+    def to_float32(self):
+        return self.rows(0, self.count)
+
+
+def open_snapshot(path):
+    """
+    Opens a snapshot, or returns None when the file is missing or unreadable.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return EmbeddingSnapshot(path)
+    except (ValueError, KeyError, struct.error):
+        return None
+
+
+class SnapshotIndex:
+    """
+    Exact L2 search over a memory-mapped snapshot, with the same search() interface and squared L2
+    distances as faiss.IndexFlatL2. Rows are decoded block by block, so searching never holds a
+    float32 copy of the whole matrix.
+
+    Parameters:
+    snapshot (EmbeddingSnapshot): The vectors to search.
+    block_rows (int): Rows decoded at a time.
+    """
+
+    def __init__(self, snapshot, block_rows=4096):
+        self.snapshot = snapshot
+        self.block_rows = block_rows
+
+    @property
+    def d(self):
+        return self.snapshot.dimension
+
+    @property
+    def ntotal(self):
+        return self.snapshot.count
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        snapshot = self.snapshot
+        count = snapshot.count
+        distances = np.empty((count, len(queries)), dtype=np.float32)
+
+        for start in range(0, count, self.block_rows):
+            stop = min(start + self.block_rows, count)
+            dots = np.asarray(snapshot.matrix[start:stop], dtype=np.float32) @ queries.T
+            if snapshot.scales is not None:
+                dots *= snapshot.scales[start:stop, None]
+            distances[start:stop] = snapshot.norms[start:stop, None] - 2 * dots
+        distances += np.einsum("ij,ij->i", queries, queries)[None, :]
+        np.maximum(distances, 0, out=distances)
+
+        # Like FAISS, missing neighbours are reported as -1
+        result_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        result_indices = np.full((len(queries), k), -1, dtype=np.int64)
+        found = min(k, count)
+        if found:
+            nearest = np.argpartition(distances, found - 1, axis=0)[:found]
+            nearest_distances = np.take_along_axis(distances, nearest, axis=0)
+            order = np.argsort(nearest_distances, axis=0)
+            result_indices[:, :found] = np.take_along_axis(nearest, order, axis=0).T
+            result_distances[:, :found] = np.take_along_axis(nearest_distances, order, axis=0).T
+        return result_distances, result_indices
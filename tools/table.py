@@ -1,32 +1,100 @@
+import io
+import os
+
+# Long regulation file names are shortened in the citation table
+MAX_DOCUMENT_NAME_LENGTH = 60
+
+
+def _cell(value):
+    # Pipes and line breaks would end the cell or the row
+    return str(value).replace("|", "\\|").replace("\n", " ")
+
+
+def write_table(out, rows):
+    """
+    Writes a Markdown table to a text stream, the first row being the header.
+    """
+    header = rows[0]
+    out.write("| ")
+    out.write(" | ".join(_cell(value) for value in header))
+    out.write(" |\n|")
+    out.write(" --- |" * len(header))
+    out.write("\n")
+    for row in rows[1:]:
+        out.write("| ")
+        out.write(" | ".join(_cell(value) for value in row))
+        out.write(" |\n")
+
+
 def generate_dynamic_table(data_list):
     """
     Generates a Markdown-formatted table based on a list of rows where each row can have any number of columns.
-    
+
     Parameters:
     data_list (list): A list of lists, where each sublist represents a row in the table.
-    
+
     Returns:
     str: A string representing the table in Markdown format.
     """
     # Check if the list is empty
-    if not data_list or len(data_list) == 0:
+    if not data_list:
         return "No data provided to generate a table."
 
-    # Dynamically generate the headers based on the first row
-    headers = "| " + " | ".join(data_list[0]) + " |\n"
-    
-    # Dynamically generate the separator row (--- for each column)
-    separator = "| " + " | ".join(['---'] * len(data_list[0])) + " |\n"
-    
-    # Initialize rows string
-    rows = ""
-    
-    # Loop through the remaining rows (excluding the header row)
-    for row in data_list[1:]:
-        # Add each row to the table (make sure it's the same length as the header row)
-        row_string = "| " + " | ".join(row) + " |\n"
-        rows += row_string
-    
-    # Combine the headers, separator, and rows
-    table_markdown = headers + separator + rows
-    return table_markdown
\ No newline at end of file
+    out = io.StringIO()
+    write_table(out, data_list)
+    return out.getvalue()
+
+
+def short_document_name(document_name):
+    name = os.path.splitext(document_name)[0].replace("-", " ").replace("_", " ")
+    if len(name) > MAX_DOCUMENT_NAME_LENGTH:
+        name = name[:MAX_DOCUMENT_NAME_LENGTH - 1].rstrip() + "…"
+    return name
+
+
+def group_citations(metadata):
+    """
+    Groups retrieval metadata by document and page.
+
+    Parameters:
+    metadata (list): {"document_name", "page_number", "distance"} entries, possibly repeated across searches.
+
+    Returns:
+    list: (document name, [(page number, distance)]) with the documents and their pages nearest first.
+    """
+    pages = {}
+    for item in metadata:
+        key = (item["document_name"], item["page_number"])
+        pages[key] = min(item["distance"], pages.get(key, item["distance"]))
+
+    documents = {}
+    for (document_name, page_number), distance in pages.items():
+        documents.setdefault(document_name, []).append((page_number, distance))
+    for document_pages in documents.values():
+        document_pages.sort(key=lambda page: page[1])
+    return sorted(documents.items(), key=lambda document: document[1][0][1])
+
+
+def build_citation_table(metadata):
+    """
+    Renders the documents and pages an answer was built from as a Markdown table, one row per
+    page grouped by document, from the retrieval metadata instead of asking the LLM to write it.
+
+    Returns:
+    str: The table, or an empty string without metadata.
+    """
+    grouped = group_citations(metadata)
+    if not grouped:
+        return ""
+
+    rows = [["Document", "Page", "Distance"]]
+    for document_name, pages in grouped:
+        name = short_document_name(document_name)
+        for page_number, distance in pages:
+            rows.append([name, page_number, f"{distance:.3f}"])
+            # The document is only named on its first row
+            name = ""
+
+    out = io.StringIO()
+    write_table(out, rows)
+    return out.getvalue()
@@ -1,109 +1,413 @@
+import heapq
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import numpy as np
-import faiss
-from llm import model  # Import the OpenAIEmbeddings model from llm.py
-from graph import graph  # Import the Neo4jGraph connection from graph.py
+import streamlit as st
+from services import get_embedding_model, neo4j_session, session_scope, shared_resource
+from tools.index_cache import FaissIndexCache
+from tools.embedding_cache import EmbeddingCache
+from tools.index_factory import build_index, configure_search
+from tools.context import build_context
+from tools.retriever import ComparingRetriever, Neo4jVectorRetriever, Retrieval, Retriever, payload_bytes
+from tools.snapshot import SnapshotIndex, SnapshotWriter, open_snapshot
+from tracing import propagate, span
 
 # List of available documents
 documents = [
     "Standard-operating-procedures-for-pharmaceuticals-good-distribution-and-storage-practices.pdf"
 ]
 
-# Function to get embedding for a query text using llm.py's model
+# Query embeddings are cached in memory and on disk, keyed by the embedding model
+@shared_resource
+def get_embedding_cache():
+    return EmbeddingCache(
+        model_id=get_embedding_model().model_id,
+        max_entries=int(st.secrets.get("EMBEDDING_CACHE_SIZE", 1024)),
+        path=st.secrets.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite"),
+    )
+
+# Function to get embedding for a query text using the shared embedding model
 def get_embedding(text):
-    return np.array(model.embed_query(text), dtype=np.float32)
+    model = get_embedding_model()
+    embedding_cache = get_embedding_cache()
+    with span("embed_query", model=model.model_id) as record:
+        embedding = embedding_cache.get(text)
+        record["cache_hit"] = embedding is not None
+        if embedding is None:
+            embedding = embedding_cache.put(text, model.embed_query(text))
+    # Return a copy so callers can't modify the cached array
+    return embedding.copy()
+
+# Bytes of embeddings pulled from Neo4j by this process, reported by the FAISS retriever
+_embedding_bytes_fetched = [0]
+_transfer_lock = threading.Lock()
+
+def count_embedding_transfer(values):
+    # Neo4j sends the vectors as 64-bit floats
+    with _transfer_lock:
+        _embedding_bytes_fetched[0] += values * 8
+
+# Fetch only entity embeddings from the specified document
+ENTITY_EMBEDDINGS_QUERY = """
+MATCH (e:Entity)
+WHERE e.file_name = $document_name
+RETURN e.name AS id, e.embedding AS embedding
+"""
+
+# The model the stored vectors come from: recorded per entity by pipelines that do, else per document by upload.py
+STORED_EMBEDDING_MODEL_QUERY = """
+OPTIONAL MATCH (d:Document {file_name: $document_name})
+OPTIONAL MATCH (e:Entity)
+WHERE e.file_name = $document_name AND e.embedding_model IS NOT NULL
+RETURN coalesce(head(collect(e.embedding_model)), d.embedding_model) AS embedding_model
+"""
 
 def fetch_embeddings_from_neo4j(document_name):
-    with graph._driver.session() as session:
-        # Fetch only entity embeddings from the specified document
-        entity_query = """
-        MATCH (e:Entity)
-        WHERE e.file_name = $document_name
-        RETURN e.name AS id, e.embedding AS embedding
-        """
-        entity_results = list(session.run(entity_query, document_name=document_name))
+    with span("neo4j.fetch_embeddings", document=document_name) as record, neo4j_session() as session:
+        entity_results = list(session.run(ENTITY_EMBEDDINGS_QUERY, document_name=document_name))
+        record["rows"] = len(entity_results)
+
+    ids = [record["id"] for record in entity_results]
+    # One conversion into a single float32 matrix, instead of an array per row stacked afterwards
+    embeddings = np.array([record["embedding"] for record in entity_results], dtype=np.float32)
+    count_embedding_transfer(embeddings.size)
+    return embeddings, ids
 
-    embeddings = []
-    ids = []
+def fetch_document_version(document_name):
+    """
+    Returns the fingerprint of a document in Neo4j.
+    The version is bumped by upload.py on every ingestion, the entity count catches
+    entities written by other pipelines that do not maintain the version.
+    """
+    return fetch_document_versions([document_name])[document_name]
 
-    # Process entity embeddings only
-    for record in entity_results:
-        embeddings.append(np.array(record["embedding"], dtype=np.float32))
-        ids.append(record["id"])
+def fetch_document_versions(document_names):
+    """
+    Returns document name -> fingerprint, see fetch_document_version(), for many documents in one query.
+    """
+    with span("neo4j.document_version", documents=len(document_names)), neo4j_session() as session:
+        query = """
+        UNWIND $document_names AS document_name
+        OPTIONAL MATCH (d:Document {file_name: document_name})
+        WITH document_name, d
+        OPTIONAL MATCH (e:Entity)
+        WHERE e.file_name = document_name
+        RETURN document_name, d.version AS version, count(e) AS entity_count
+        """
+        records = list(session.run(query, document_names=list(document_names)))
+    return {record["document_name"]: f"{record['version'] or 0}:{record['entity_count']}" for record in records}
 
-    return np.array(embeddings), ids
+# Index type used for every document: "flat" (exact), "ivf_flat", "hnsw" or "ivf_pq"
+FAISS_INDEX_TYPE = st.secrets.get("FAISS_INDEX_TYPE", "flat")
+FAISS_NPROBE = int(st.secrets.get("FAISS_NPROBE", 8))
+FAISS_EF_SEARCH = int(st.secrets.get("FAISS_EF_SEARCH", 64))
 
 def build_faiss_index(embeddings):
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
-    return index
+    with span("faiss.build", index_type=FAISS_INDEX_TYPE, rows=len(embeddings)):
+        return build_index(embeddings, FAISS_INDEX_TYPE, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH)
+
+def configure_faiss_index(index):
+    return configure_search(index, nprobe=FAISS_NPROBE, ef_search=FAISS_EF_SEARCH)
+
+def faiss_index_variant():
+    # Names the persisted indexes, changing the index settings must not load indexes built with the old ones
+    return f"{FAISS_INDEX_TYPE}-nprobe{FAISS_NPROBE}-ef{FAISS_EF_SEARCH}"
+
+# Entity embeddings are exported once per document version to compact snapshots ("" disables them).
+# Retrieval memory-maps them, so all worker processes share one page-cached copy of the vectors.
+EMBEDDING_SNAPSHOT_DIR = st.secrets.get("EMBEDDING_SNAPSHOT_DIR", ".cache/snapshots")
+# "float32" (exact), "float16" (half the size, slower to search as numpy decodes it without SIMD)
+# or "int8" (a quarter of the size, with a scale per vector)
+EMBEDDING_SNAPSHOT_DTYPE = st.secrets.get("EMBEDDING_SNAPSHOT_DTYPE", "float32")
+
+def snapshot_path(document_name):
+    return os.path.join(EMBEDDING_SNAPSHOT_DIR, re.sub(r"[^A-Za-z0-9._-]", "_", document_name) + ".emb")
+
+def export_document_snapshot(document_name, version=None, dtype=None):
+    """
+    Streams a document's entity embeddings and ids from Neo4j into its snapshot file.
+    """
+    version = version or fetch_document_version(document_name)
+    dtype = dtype or EMBEDDING_SNAPSHOT_DTYPE
+    path = snapshot_path(document_name)
+    with span("snapshot.export", document=document_name, dtype=dtype) as record, neo4j_session() as session:
+        # None when nothing recorded which model embedded the document
+        model_id = session.run(STORED_EMBEDDING_MODEL_QUERY, document_name=document_name).single()["embedding_model"]
+        with SnapshotWriter(path, dtype=dtype, model_id=model_id, version=version) as writer:
+            for row in session.run(ENTITY_EMBEDDINGS_QUERY, document_name=document_name):
+                writer.append(row["embedding"], row["id"])
+        record["rows"] = writer.count
+    count_embedding_transfer(writer.count * (writer.dimension or 0))
+    return path
+
+def open_document_snapshot(document_name, version):
+    """
+    Memory-maps the snapshot of a document version, exporting it first when it is missing or outdated.
+    Returns None when the snapshot can't be written or read back.
+    """
+    snapshot = open_snapshot(snapshot_path(document_name))
+    # Re-embedding a document bumps its version, which also covers a change of embedding model
+    if snapshot is None or snapshot.version != version or snapshot.dtype != EMBEDDING_SNAPSHOT_DTYPE:
+        try:
+            export_document_snapshot(document_name, version)
+        except OSError as e:
+            print(f"Exporting the embedding snapshot of {document_name} failed: {e}")
+            return None
+        snapshot = open_snapshot(snapshot_path(document_name))
+    return snapshot
+
+def load_document_index(document_name, version):
+    snapshot = open_document_snapshot(document_name, version) if EMBEDDING_SNAPSHOT_DIR else None
+    if snapshot is None:
+        # Snapshots are disabled or unavailable, the index is built from the vectors in Neo4j
+        embeddings, ids = fetch_embeddings_from_neo4j(document_name)
+        if embeddings.size == 0:
+            return None, ids
+        return build_faiss_index(embeddings), ids
+
+    if snapshot.model_id and snapshot.model_id != get_embedding_model().model_id:
+        print(f"{document_name} was embedded with {snapshot.model_id}, "
+              f"queries use {get_embedding_model().model_id}: re-ingest it for meaningful distances")
+    if snapshot.count == 0:
+        return None, snapshot.ids
+    if FAISS_INDEX_TYPE == "flat":
+        # Exact search runs on the mapped vectors directly, no per-process float32 copy
+        return SnapshotIndex(snapshot), snapshot.ids
+    return build_faiss_index(snapshot.to_float32()), snapshot.ids
+
+# Process-wide cache so warm queries skip fetching embeddings and rebuilding the index
+@shared_resource
+def get_index_cache():
+    return FaissIndexCache(
+        loader=load_document_index,
+        version_fetcher=fetch_document_version,
+        cache_dir=st.secrets.get("FAISS_CACHE_DIR"),
+        check_interval=float(st.secrets.get("FAISS_VERSION_CHECK_SECONDS", 30)),
+        prepare=configure_faiss_index,
+        variant=faiss_index_variant(),
+    )
+
+def corpus_version():
+    """
+    Fingerprints of all documents, changes whenever a document is re-ingested. Read from Neo4j in one
+    query, independently of the retrieval backend, so no index is loaded for it.
+
+    Returns:
+    tuple: (document name, fingerprint) pairs, or None when Neo4j couldn't be read.
+    """
+    try:
+        versions = fetch_document_versions(documents)
+    except Exception as e:
+        print(f"Reading the document versions failed: {e}")
+        return None
+    return tuple((document, versions.get(document)) for document in documents)
+
+# Bounded pool shared by all sessions for fanning retrieval out across documents
+RETRIEVAL_MAX_WORKERS = int(st.secrets.get("RETRIEVAL_MAX_WORKERS", 4))
+RETRIEVAL_DOCUMENT_TIMEOUT = float(st.secrets.get("RETRIEVAL_DOCUMENT_TIMEOUT", 10))
+# Maximum tokens of retrieved context per document and for the merged result
+CONTEXT_TOKEN_BUDGET = int(st.secrets.get("CONTEXT_TOKEN_BUDGET", 3000))
+
+@shared_resource
+def get_retrieval_pool():
+    return ThreadPoolExecutor(max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
 
 def query_faiss_index(query_embedding, index, ids, top_k=3):
-    distances, indices = index.search(query_embedding, top_k)
-    results = [(ids[i], distances[0][idx]) for idx, i in enumerate(indices[0])]
+    with span("faiss.search", rows=index.ntotal, top_k=top_k):
+        distances, indices = index.search(query_embedding, top_k)
+    # Approximate indexes and small documents return -1 for missing neighbours
+    results = [(ids[i], distances[0][idx]) for idx, i in enumerate(indices[0]) if i >= 0]
     return results
 
 def get_entity_details_with_chunks(entity_name):
-    with graph._driver.session() as session:
+    return get_entities_details_with_chunks([entity_name]).get(entity_name)
+
+def get_entities_details_with_chunks(entity_names):
+    """
+    Resolves the descriptions and connected chunks of many entities in a single round-trip.
+
+    Returns:
+    dict: entity name -> {"descriptions": ..., "connected_chunk_details": [...]}
+    """
+    unique_names = list(dict.fromkeys(entity_names))
+    if not unique_names:
+        return {}
+
+    with span("neo4j.hydrate_entities", entities=len(unique_names)) as record, neo4j_session() as session:
         query = """
-        MATCH (e:Entity {name: $entity_name})-[:MENTIONS]-(chunk:Chunk)
-        RETURN e.descriptions AS descriptions, 
+        UNWIND $entity_names AS entity_name
+        MATCH (e:Entity {name: entity_name})-[:MENTIONS]-(chunk:Chunk)
+        RETURN entity_name,
+               e.descriptions AS descriptions,
                collect({
-                   content: chunk.content, 
-                   page_number: chunk.page_number, 
+                   content: chunk.content,
+                   page_number: chunk.page_number,
                    filename: chunk.file_name
                }) AS connected_chunk_details
         """
-        result = session.run(query, entity_name=entity_name)
-        return result.single()
+        records = list(session.run(query, entity_names=unique_names))
+        record["rows"] = len(records)
 
-def get_medic_docs(input_text):
+    details = {}
+    for record in records:
+        # Keep the first match when several entities share a name, as result.single() used to
+        details.setdefault(record["entity_name"], {
+            "descriptions": record["descriptions"],
+            "connected_chunk_details": record["connected_chunk_details"],
+        })
+    return details
+
+def search_document(document, query_embedding, top_k=5):
     """
-    Queries all available documents individually by retrieving only relevant chunks from each document.
+    Searches a single document's index, returns None when the document has no embeddings.
+    """
+    # The version check and a rebuild's embedding fetch share one session
+    with session_scope():
+        cached = get_index_cache().get(document)
+    if cached is None:
+        return None
+    if cached.index.d != query_embedding.shape[1]:
+        # The document was embedded with another model, its vectors can't be compared with the query
+        raise ValueError(
+            f"Embedding dimension mismatch for {document}: index has {cached.index.d}, "
+            f"query from {get_embedding_model().model_id} has {query_embedding.shape[1]}"
+        )
+    return query_faiss_index(query_embedding, cached.index, cached.ids, top_k=top_k)
+
+def build_enriched_result(results, entity_details, token_budget=None):
+    """
+    Builds the context, metadata and chunks for a list of (entity name, distance) hits.
+    """
+    context, metadata = build_context(results, entity_details, token_budget or CONTEXT_TOKEN_BUDGET)
+
+    # Structure the response similarly to the example method
+    return {
+        "context": context,
+        "metadata": metadata,
+        "chunks": results
+    }
+
+class FaissRetriever(Retriever):
+    """
+    Client-side search: every document's entity embeddings are loaded into a cached index and
+    searched concurrently on the retrieval pool, the hits are then hydrated with one query.
+    """
+
+    name = "faiss"
+
+    def __init__(self):
+        # document -> search still running after its query gave up on it. A running search can't be
+        # cancelled, so each document holds at most one pool worker with abandoned work.
+        self._abandoned = {}
+        self._lock = threading.Lock()
+
+    def retrieve(self, query_embedding, documents, top_k, timeout):
+        started = time.monotonic()
+        embedding_bytes = _embedding_bytes_fetched[0]
+        futures = {}
+        timed_out = []
+        for document in documents:
+            with self._lock:
+                abandoned = self._abandoned.get(document)
+                if abandoned is not None and abandoned.done():
+                    del self._abandoned[document]
+                    abandoned = None
+            if abandoned is not None:
+                # Queueing behind it would only time out as well
+                timed_out.append(document)
+                print(f"Retrieval skipped for document {document}, its previous search is still running")
+                continue
+            futures[document] = get_retrieval_pool().submit(propagate(search_document), document, query_embedding, top_k)
+
+        search_results = {}
+        for document, future in futures.items():
+            remaining = max(0.0, started + timeout - time.monotonic())
+            try:
+                results = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                with self._lock:
+                    self._abandoned[document] = future
+                timed_out.append(document)
+                print(f"Retrieval timed out after {timeout}s for document: {document}")
+                continue
+            except Exception as e:
+                print(f"Retrieval failed for document {document}: {e}")
+                continue
+            if results:
+                search_results[document] = results
+
+        # Hydrate the hits of every document with one query
+        entity_details = get_entities_details_with_chunks(
+            [entity_name for results in search_results.values() for entity_name, _ in results]
+        )
+        # Embeddings are only pulled when an index is (re)loaded, concurrent queries may count each other's loads
+        transferred = payload_bytes(list(entity_details.values())) + _embedding_bytes_fetched[0] - embedding_bytes
+        return Retrieval(search_results, entity_details, timed_out, transferred)
+
+# "faiss" searches indexes built from the embeddings pulled to the client, "neo4j" the native vector index,
+# "compare" runs both on every query and answers from FAISS
+RETRIEVAL_BACKEND = st.secrets.get("RETRIEVAL_BACKEND", "faiss")
+VECTOR_INDEX_NAME = st.secrets.get("VECTOR_INDEX_NAME", "entity_embedding")
+VECTOR_INDEX_SIMILARITY = st.secrets.get("VECTOR_INDEX_SIMILARITY", "euclidean")
+VECTOR_INDEX_OVERSAMPLE = int(st.secrets.get("VECTOR_INDEX_OVERSAMPLE", 4))
+
+@shared_resource
+def get_retriever():
+    if RETRIEVAL_BACKEND == "faiss":
+        return FaissRetriever()
+    native = Neo4jVectorRetriever(VECTOR_INDEX_NAME, VECTOR_INDEX_SIMILARITY, VECTOR_INDEX_OVERSAMPLE)
+    if RETRIEVAL_BACKEND == "neo4j":
+        return native
+    if RETRIEVAL_BACKEND == "compare":
+        return ComparingRetriever(FaissRetriever(), native)
+    raise ValueError(f"Unknown RETRIEVAL_BACKEND: {RETRIEVAL_BACKEND}")
+
+def search_documents(input_text, top_k=5, timeout=None, merged_k=None):
     """
-    responses = {}
+    Searches all available documents with a single shared query embedding, through the
+    retriever selected by RETRIEVAL_BACKEND.
+
+    Parameters:
+    input_text (str): The user's query.
+    top_k (int): Number of hits per document.
+    timeout (float): Seconds each document may take before it is left out of the answer.
+    merged_k (int): Number of hits in the merged result, defaults to top_k.
+
+    Returns:
+    dict: {"documents": per-document results, "merged": global top-k result, "timed_out": [document names]}
+    """
+    if timeout is None:
+        timeout = RETRIEVAL_DOCUMENT_TIMEOUT
     query_embedding = get_embedding(input_text).reshape(1, -1)
 
-    for document in documents:
-        embeddings, ids = fetch_embeddings_from_neo4j(document)
-        if embeddings.size == 0:
-            continue
-
-        index = build_faiss_index(embeddings)
-        results = query_faiss_index(query_embedding, index, ids, top_k=5)
-
-        context = ""
-        metadata = []
-
-        for result in results:
-            entity_name = result[0]
-            distance = result[1]
-
-            # Get details of the entity and its connected chunks
-            entity_details = get_entity_details_with_chunks(entity_name)
-            if entity_details:
-                descriptions = entity_details['descriptions']
-                connected_chunks = entity_details['connected_chunk_details']
-
-                # Collect context and metadata
-                context += f"\nEntity: {entity_name}\nDescription: {descriptions}\n"
-                for chunk in connected_chunks:
-                    context += f"Chunk Content: {chunk['content']}\n"
-                    metadata.append({
-                        "document_name": chunk['filename'],
-                        "page_number": chunk['page_number'],
-                        "distance": distance
-                    })
-
-        # Structure the response similarly to the example method
-        enriched_result = {
-            "context": context.strip(),
-            "metadata": metadata,
-            "chunks": results
-        }
-        responses[document] = enriched_result
-
-    return responses
+    retrieval = get_retriever().retrieve(query_embedding, documents, top_k, timeout)
+    search_results, entity_details = retrieval.hits, retrieval.entity_details
+
+    responses = {
+        document: build_enriched_result(results, entity_details)
+        for document, results in search_results.items()
+    }
+
+    merged_hits = heapq.nsmallest(
+        merged_k or top_k,
+        ((distance, document, entity_name)
+         for document, results in search_results.items()
+         for entity_name, distance in results),
+        key=lambda hit: hit[0],
+    )
+    merged = build_enriched_result([(entity_name, distance) for distance, _, entity_name in merged_hits], entity_details)
+    merged["documents"] = [document for _, document, _ in merged_hits]
+
+    return {"documents": responses, "merged": merged, "timed_out": retrieval.timed_out}
+
+def get_medic_docs(input_text):
+    """
+    Queries all available documents individually by retrieving only relevant chunks from each document.
+    """
+    return search_documents(input_text)["documents"]
 
 # # Example query
 # results = get_medic_docs("what are the audit requirements?")
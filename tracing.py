@@ -0,0 +1,261 @@
+"""
+    Lightweight span-based tracing of the request path.
+
+    A request (one answered question) collects spans for every stage: query embedding, embedding fetch,
+    FAISS build/search, entity hydration, chat history reads/writes and LLM calls, each with its
+    duration and attributes such as row and token counts.
+
+    Finished requests are:
+    - logged as one JSON line on the "medic.trace" logger (TRACE_LOG = "stderr" or a file path),
+    - kept in memory for the debug timing panel in bot.py,
+    - aggregated into Prometheus histograms, served as text on METRICS_HOST:METRICS_PORT when the port is set.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+
+logger = logging.getLogger("medic.trace")
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_REQUESTS = 100
+
+_current_request = contextvars.ContextVar("current_request", default=None)
+_lock = threading.Lock()
+_recent = OrderedDict()
+_histograms = {}
+_requests_total = {}
+_gauges = {}
+
+
+class RequestTrace:
+    def __init__(self, name, request_id=None, **attributes):
+        self.name = name
+        self.request_id = request_id or new_request_id()
+        self.attributes = attributes
+        self.spans = []
+        self.started_at = time.time()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def add_span(self, record):
+        with self._lock:
+            self.spans.append(record)
+
+    def to_dict(self):
+        return {
+            "request_id": self.request_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 2) if self.duration is not None else None,
+            **self.attributes,
+            "spans": list(self.spans),
+        }
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_request():
+    return _current_request.get()
+
+
+@contextmanager
+def start_request(name, request_id=None, **attributes):
+    """
+    Starts a request trace; spans opened in this context (and in contexts copied from it) belong to it.
+    """
+    trace = RequestTrace(name, request_id, **attributes)
+    token = _current_request.set(trace)
+    started = time.perf_counter()
+    try:
+        yield trace
+    except Exception as e:
+        trace.attributes["error"] = str(e)
+        raise
+    finally:
+        trace.duration = time.perf_counter() - started
+        _current_request.reset(token)
+        _finish(trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times a stage. The yielded dict can be filled with attributes (row counts, token counts...) before it closes.
+    """
+    record = {"span": name, **attributes}
+    started = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = str(e)
+        raise
+    finally:
+        record_span(name, time.perf_counter() - started, record)
+
+
+def record_span(name, duration, attributes=None):
+    """
+    Records an already measured stage, e.g. from a callback that only sees its start and end.
+    """
+    record = dict(attributes or {}, span=name, duration_ms=round(duration * 1000, 2))
+    trace = _current_request.get()
+    if trace is not None:
+        record["request_id"] = trace.request_id
+        trace.add_span(record)
+    _observe(f"span:{name}", duration)
+
+
+def propagate(function):
+    """
+    Wraps a function so it runs in a copy of the current context, e.g. when submitted to a thread pool,
+    keeping its spans attached to the current request.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(function, *args, **kwargs)
+
+
+def get_request(request_id):
+    with _lock:
+        trace = _recent.get(request_id)
+    return trace.to_dict() if trace is not None else None
+
+
+def recent_requests():
+    with _lock:
+        return [trace.to_dict() for trace in _recent.values()]
+
+
+def span_counts():
+    """
+    Number of spans recorded per name since the process started.
+    """
+    with _lock:
+        return {key.split(":", 1)[1]: histogram["count"] for key, histogram in _histograms.items() if key.startswith("span:")}
+
+
+def register_gauge(name, description, read):
+    """
+    Exposes read() as a gauge on /metrics, read at scrape time. read() may return None when there is nothing to report yet.
+    """
+    with _lock:
+        _gauges[name] = (description, read)
+
+
+def _observe(key, duration):
+    with _lock:
+        histogram = _histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "count": 0, "sum": 0.0})
+        histogram["count"] += 1
+        histogram["sum"] += duration
+        for position, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                histogram["buckets"][position] += 1
+
+
+def _finish(trace):
+    status = "error" if "error" in trace.attributes else "ok"
+    _observe(f"request:{trace.name}", trace.duration)
+    with _lock:
+        _requests_total[(trace.name, status)] = _requests_total.get((trace.name, status), 0) + 1
+        _recent[trace.request_id] = trace
+        while len(_recent) > RECENT_REQUESTS:
+            _recent.popitem(last=False)
+    logger.info(json.dumps(trace.to_dict(), default=str))
+
+
+def render_prometheus():
+    """
+    Renders the collected metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        "# HELP medic_requests_total Requests traced, by name and status.",
+        "# TYPE medic_requests_total counter",
+    ]
+    with _lock:
+        for (name, status), count in sorted(_requests_total.items()):
+            lines.append(f'medic_requests_total{{request="{name}",status="{status}"}} {count}')
+
+        for metric, kind in (("medic_request_duration_seconds", "request"), ("medic_span_duration_seconds", "span")):
+            lines.append(f"# HELP {metric} Duration of traced {kind}s.")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, histogram in sorted(_histograms.items()):
+                prefix, name = key.split(":", 1)
+                if prefix != kind:
+                    continue
+                # _observe counts every bucket whose bound is above the duration, so they are already cumulative
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f'{metric}_bucket{{{kind}="{name}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{kind}="{name}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'{metric}_sum{{{kind}="{name}"}} {histogram["sum"]:.6f}')
+                lines.append(f'{metric}_count{{{kind}="{name}"}} {histogram["count"]}')
+        gauges = sorted(_gauges.items())
+
+    # Read outside the lock, the callbacks may take their own locks
+    for name, (description, read) in gauges:
+        value = read()
+        if value is None:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_metrics_server = None
+
+
+def start_metrics_server(port, host="127.0.0.1"):
+    """
+    Serves /metrics on the given port from a daemon thread, once per process. Only local
+    scrapers can reach it unless host is set to another interface, e.g. "0.0.0.0".
+    """
+    global _metrics_server
+    with _lock:
+        if _metrics_server is not None:
+            return _metrics_server
+        _metrics_server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+    return _metrics_server
+
+
+def configure(log_target=None, metrics_port=None, metrics_host=None):
+    """
+    Sends the JSON request logs to stderr or a file and starts the metrics endpoint if requested.
+    """
+    if log_target and not logger.handlers:
+        handler = logging.StreamHandler() if log_target == "stderr" else logging.FileHandler(log_target)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    if metrics_port:
+        start_metrics_server(int(metrics_port), metrics_host or "127.0.0.1")
+
+
+configure(st.secrets.get("TRACE_LOG"), st.secrets.get("METRICS_PORT"), st.secrets.get("METRICS_HOST"))
@@ -37,108 +37,648 @@
     That way, we start to be paid the real monetary prices; there is no gold greater than hope. He who has struck hope has struck gold.
 """
 import streamlit as st
-import fitz
+import hashlib
+import io
 import os
-import boto3
-from docx import Document
-from neo4j import GraphDatabase
-from llm import model
-
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=st.secrets['AWS_ACCESS_KEY'],
-    aws_secret_access_key=st.secrets['AWS_SECRET_KEY'],
-    region_name=st.secrets['AWS_REGION']
-)
-
-# NEO4J Driver initialization
-driver = GraphDatabase.driver(st.secrets["NEO4J_URI"], auth=("neo4j", st.secrets["NEO4J_PASSWORD"]))
-
-# 1. File Upload and Save
-def save_uploaded_file(uploaded_file):
-    file_path = uploaded_file.name
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    return file_path
+import queue
+import random
+import tempfile
+import threading
+import time
+import zlib
+from openai import BadRequestError, RateLimitError
+from services import get_embedding_model, get_s3_client, neo4j_session
+from tools.vector import RETRIEVAL_BACKEND, get_index_cache
+
+# The S3 client, the Neo4j driver and the embedding model are shared with the rest of the app
+# and created on first use (see services.py)
+
+# 1. Uploaded Files
+# Uploads are ingested from memory: extraction and the S3 upload read the same buffer concurrently.
+# Larger uploads are written to a private temporary file first, the pipeline then reads from disk.
+UPLOAD_MEMORY_LIMIT_MB = float(st.secrets.get("UPLOAD_MEMORY_LIMIT_MB", 100))
+# Parts of the multipart S3 upload and how many are sent at once
+S3_MULTIPART_CHUNK_MB = int(st.secrets.get("S3_MULTIPART_CHUNK_MB", 8))
+S3_MAX_CONCURRENCY = int(st.secrets.get("S3_MAX_CONCURRENCY", 4))
+
+def uploaded_buffer(uploaded_file):
+    """
+    The uploaded bytes as a memoryview, without copying them.
+    """
+    # Streamlit's UploadedFile is a BytesIO over the received bytes: getvalue() returns those bytes
+    # as they are, while getbuffer() first makes a private copy of them
+    if hasattr(uploaded_file, "getvalue"):
+        return memoryview(uploaded_file.getvalue())
+    return uploaded_file.getbuffer()
+
+class MemoryReader(io.RawIOBase):
+    """
+    Read-only, seekable file over a memoryview. Every reader has its own position, so several
+    can read the same buffer at once, and only what is read is copied.
+    """
+
+    def __init__(self, buffer):
+        self._buffer = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, target):
+        size = min(len(target), len(self._buffer) - self._position)
+        if size <= 0:
+            return 0
+        target[:size] = self._buffer[self._position:self._position + size]
+        self._position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._buffer)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+def open_source(source):
+    """
+    A binary file for a path or a buffer.
+    """
+    if isinstance(source, str):
+        return open(source, "rb")
+    return io.BufferedReader(MemoryReader(source))
+
+def spill_to_temp_file(buffer, file_name):
+    """
+    Writes a buffer to a new temporary file only this user can read, named after nothing the uploader chose
+    but the extension. The caller removes it.
+    """
+    descriptor, path = tempfile.mkstemp(prefix="medic-upload-", suffix=os.path.splitext(file_name)[1].lower())
+    with os.fdopen(descriptor, "wb") as f:
+        f.write(buffer)
+    return path
 
 # 2. Text Extraction Functions
-def extract_text_from_pdf(file_path):
-    with fitz.open(file_path) as doc:
-        text = ""
-        for page in doc:
-            text += page.get_text()
-    return text
+# Each extractor yields (page_number, text) so chunks carry real page numbers and
+# only a few pages are held in memory at a time.
+# Formats without reliable page boundaries are cut into blocks of about TEXT_BLOCK_SIZE characters,
+# never shorter than a quarter of it nor longer than four times it
+TEXT_BLOCK_SIZE = 4000
+
+def ends_block(text, block_size):
+    """
+    Whether a block of block_size characters ends after this paragraph or line. Boundaries depend on
+    the text around them rather than on the offset, so an edit only moves the boundaries next to it
+    and the blocks after it keep their chunks.
+    """
+    if block_size < TEXT_BLOCK_SIZE // 4:
+        return False
+    if block_size >= TEXT_BLOCK_SIZE * 4:
+        return True
+    # Longer text is proportionally likelier to end a block
+    return zlib.crc32(text.encode("utf-8")) < min(len(text) / TEXT_BLOCK_SIZE, 1.0) * 2 ** 32
+
+def extract_pages_from_pdf(source):
+    # PyMuPDF and python-docx are only loaded when a file of their format is ingested
+    import fitz
+
+    if isinstance(source, str):
+        doc = fitz.open(source)
+    else:
+        # The pinned PyMuPDF only takes bytes streams, the uploaded bytes themselves when they are
+        stream = source.obj if isinstance(source.obj, bytes) and source.nbytes == len(source.obj) else bytes(source)
+        doc = fitz.open(stream=stream, filetype="pdf")
+    with doc:
+        for page_number, page in enumerate(doc, start=1):
+            yield page_number, page.get_text()
+
+def extract_pages_from_docx(source):
+    from docx import Document
+
+    with open_source(source) as f:
+        doc = Document(f)
+    # Word saves a rendered break where each page began, after the breaks the author inserted too.
+    # Counting both would count hard breaks twice, files never laid out by Word only have the explicit ones.
+    rendered = bool(doc.element.body.xpath('.//w:lastRenderedPageBreak'))
+    page_number = 1
+    block = []
+    block_size = 0
+    for para in doc.paragraphs:
+        segments = paragraph_segments(para, rendered)
+        for i, text in enumerate(segments):
+            if i > 0:
+                # Text before a break stays on the previous page
+                if block:
+                    yield page_number, "\n".join(block)
+                    block, block_size = [], 0
+                page_number += 1
+            if not text and len(segments) > 1:
+                continue
+            block.append(text)
+            block_size += len(text) + 1
+            if ends_block(text, block_size):
+                yield page_number, "\n".join(block)
+                block, block_size = [], 0
+    if block:
+        yield page_number, "\n".join(block)
 
-def extract_text_from_docx(file_path):
-    doc = Document(file_path)
-    return "\n".join([para.text for para in doc.paragraphs])
+def paragraph_segments(para, rendered):
+    """
+    Splits the text of a docx paragraph at its page breaks, the rendered ones or the explicit ones.
+    """
+    from docx.oxml.ns import qn
 
-def extract_text_from_txt(file_path):
-    with open(file_path, 'r') as file:
-        return file.read()
+    segments = [[]]
+    for element in para._p.xpath('.//w:t | .//w:tab | .//w:br | .//w:cr | .//w:lastRenderedPageBreak'):
+        if element.tag == qn("w:lastRenderedPageBreak"):
+            if rendered:
+                segments.append([])
+        elif element.tag == qn("w:br") and element.get(qn("w:type")) == "page":
+            if not rendered:
+                segments.append([])
+        elif element.tag == qn("w:t"):
+            segments[-1].append(element.text or "")
+        elif element.tag == qn("w:tab"):
+            segments[-1].append("\t")
+        elif element.tag in (qn("w:br"), qn("w:cr")) and element.get(qn("w:type")) != "column":
+            segments[-1].append("\n")
+    return ["".join(segment) for segment in segments]
+
+# Text files are decoded the same way from disk and from memory, whatever the server's locale.
+# Bytes that aren't UTF-8 become U+FFFD instead of failing the whole ingestion.
+TEXT_ENCODING = "utf-8"
+TEXT_ENCODING_ERRORS = "replace"
+
+def extract_pages_from_txt(source):
+    # Form feeds separate pages in text exports, long pages are yielded in segments
+    page_number = 1
+    segment = []
+    segment_size = 0
+    if isinstance(source, str):
+        file = open(source, 'r', encoding=TEXT_ENCODING, errors=TEXT_ENCODING_ERRORS)
+    else:
+        file = io.TextIOWrapper(open_source(source), encoding=TEXT_ENCODING, errors=TEXT_ENCODING_ERRORS)
+    with file:
+        for line in file:
+            for i, part in enumerate(line.split("\f")):
+                if i > 0:
+                    if segment:
+                        yield page_number, "".join(segment)
+                        segment, segment_size = [], 0
+                    page_number += 1
+                segment.append(part)
+                segment_size += len(part)
+            if ends_block(line, segment_size):
+                yield page_number, "".join(segment)
+                segment, segment_size = [], 0
+    if segment:
+        yield page_number, "".join(segment)
 
 # 3. Determine File Type and Extract Text
-def extract_text(file_path):
-    ext = os.path.splitext(file_path)[1].lower()
+def extract_pages(source, file_name=None):
+    """
+    Extracts (page_number, text) pairs from a file path, or from a buffer whose format is given by file_name.
+    """
+    ext = os.path.splitext(file_name or source)[1].lower()
     if ext == ".pdf":
-        return extract_text_from_pdf(file_path)
+        return extract_pages_from_pdf(source)
     elif ext == ".docx":
-        return extract_text_from_docx(file_path)
+        return extract_pages_from_docx(source)
     elif ext == ".txt":
-        return extract_text_from_txt(file_path)
+        return extract_pages_from_txt(source)
     else:
         raise ValueError(f"Unsupported file type: {ext}")
 
-# 4. Generate OpenAI Embeddings
+def chunk_pages(pages, chunk_size=1000):
+    """
+    Splits a stream of (page_number, text) into chunks of at most chunk_size characters.
+    Chunks never span pages, so editing a page only changes the chunks of that page.
+    """
+    for page_number, text in pages:
+        for start in range(0, len(text or ""), chunk_size):
+            yield page_number, text[start:start + chunk_size]
+
+# 4. Generate Embeddings with the configured backend (OpenAI or local)
 def generate_embeddings(text):
-    return model.embed_query(text)
+    return get_embedding_model().embed_query(text)
+
+EMBEDDING_BATCH_SIZE = int(st.secrets.get("EMBEDDING_BATCH_SIZE", 64))
+EMBEDDING_MAX_CONCURRENCY = int(st.secrets.get("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_MAX_RETRIES = int(st.secrets.get("EMBEDDING_MAX_RETRIES", 5))
+
+class AdaptiveBatchSize:
+    """
+    Batch size shared by all embedding workers of an ingestion.
+    It halves when the API pushes back and slowly grows again after successful batches.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.value = initial
+
+    def shrink(self):
+        self.value = max(self.minimum, self.value // 2)
+
+    def grow(self):
+        self.value = min(self.maximum, self.value + max(1, self.value // 4))
+
+def embed_batch_with_retry(texts, batch_size=None):
+    """
+    Embeds a batch with embed_documents, retrying with exponential backoff on rate limits.
+    Batches rejected as too large are split in half.
+    """
+    for attempt in range(EMBEDDING_MAX_RETRIES):
+        try:
+            embeddings = get_embedding_model().embed_documents(texts)
+            if batch_size is not None:
+                batch_size.grow()
+            return embeddings
+        except RateLimitError:
+            if batch_size is not None:
+                batch_size.shrink()
+            delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+            print(f"Embedding rate limited, retrying batch of {len(texts)} in {delay:.1f}s")
+            time.sleep(delay)
+        except BadRequestError:
+            # Usually the request exceeded the token limit of a single call
+            if len(texts) == 1:
+                raise
+            if batch_size is not None:
+                batch_size.shrink()
+            middle = len(texts) // 2
+            return embed_batch_with_retry(texts[:middle], batch_size) + embed_batch_with_retry(texts[middle:], batch_size)
+
+    # Last attempt without catching, so the error reaches the caller
+    return get_embedding_model().embed_documents(texts)
 
 # 5. Create and Upload to Neo4j with Chunk Handling
-def upload_to_neo4j(file_name, chunks):
-    with driver.session(database="neo4j") as session:
-        for page_number, (chunk_text, doc_embedding) in enumerate(chunks, start=1):
-            # Create the document node for each chunk
-            query = """
-            MERGE (d:Chunk {fileName: $file_name, text: $chunk_text, page_number: $page_number})
-            SET d.embedding = $embedding
-            """
-            session.run(query, file_name=file_name, chunk_text=chunk_text, embedding=doc_embedding, page_number=page_number)
-            
-            # Create relationships with existing chunks
-            existing_chunks = session.run("MATCH (d:Chunk) RETURN d.fileName AS fileName").data()
-            for existing_chunk in existing_chunks:
-                session.run("""
-                    MATCH (d:Chunk {fileName: $new_file_name})
-                    MATCH (e:Chunk {fileName: $existing_file_name})
-                    MERGE (d)-[:RELATED_TO]->(e)
-                    """, new_file_name=file_name, existing_file_name=existing_chunk['fileName'])
-
-# 6. Upload File to S3
-def upload_file_to_s3(file_path, file_name):
-    try:
-        s3_client.upload_file(file_path, st.secrets['S3_BUCKET_NAME'], file_name)
-        st.success(f"File '{file_name}' uploaded to S3 successfully!")
-    except Exception as e:
-        st.error(f"Failed to upload file to S3: {str(e)}")
+NEO4J_WRITE_BATCH_SIZE = int(st.secrets.get("NEO4J_WRITE_BATCH_SIZE", 500))
+_constraints_created = False
+
+def ensure_constraints():
+    """
+    Creates the uniqueness constraints the bulk writer merges on, once per process.
+    """
+    global _constraints_created
+    if _constraints_created:
+        return
+    with neo4j_session() as session:
+        session.run("CREATE CONSTRAINT chunk_id IF NOT EXISTS FOR (c:Chunk) REQUIRE c.chunk_id IS UNIQUE")
+        session.run("CREATE CONSTRAINT document_file_name IF NOT EXISTS FOR (d:Document) REQUIRE d.file_name IS UNIQUE")
+    _constraints_created = True
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def make_chunk_id(file_name, chunk_hash, occurrence=0):
+    # Content-addressed: an unchanged chunk keeps its id wherever it moves in the document,
+    # repeated chunks (e.g. boilerplate) are told apart by their occurrence
+    return hashlib.sha1(f"{file_name}:{chunk_hash}:{occurrence}".encode("utf-8")).hexdigest()
+
+def identify_chunks(file_name, chunks):
+    """
+    Turns (page_number, chunk_text) pairs, or (page_number, chunk_text, embedding) triples, into the rows
+    written to Neo4j, with their content hash, id and position.
+    """
+    occurrences = {}
+    for position, (page_number, chunk_text, *embedding) in enumerate(chunks, start=1):
+        chunk_hash = content_hash(chunk_text)
+        occurrence = occurrences.get(chunk_hash, 0)
+        occurrences[chunk_hash] = occurrence + 1
+        yield {
+            "chunk_id": make_chunk_id(file_name, chunk_hash, occurrence),
+            "content_hash": chunk_hash,
+            "position": position,
+            "page_number": page_number,
+            "text": chunk_text,
+            "embedding": embedding[0] if embedding else None,
+        }
+
+def fetch_stored_chunks(file_name):
+    """
+    Returns chunk_id -> {"embedding_model", "page_number", "position"} for the chunks stored for a document.
+    """
+    with neo4j_session() as session:
+        result = session.run("""
+            MATCH (c:Chunk)-[:PART_OF]->(:Document {file_name: $file_name})
+            RETURN c.chunk_id AS chunk_id, c.embedding_model AS embedding_model,
+                   c.page_number AS page_number, c.position AS position
+            """, file_name=file_name)
+        return {record["chunk_id"]: record.data() for record in result}
+
+def delete_chunks(tx, chunk_ids):
+    # Chunks of the previous version that are no longer in the document
+    tx.run("""
+        UNWIND $chunk_ids AS chunk_id
+        MATCH (c:Chunk {chunk_id: chunk_id})
+        DETACH DELETE c
+        """, chunk_ids=chunk_ids)
+
+def write_chunk_batch(tx, file_name, rows):
+    """
+    Writes chunks merged on their content-addressed id. Rows without an embedding are unchanged
+    chunks that moved: only their position and page are updated, their text and embedding are kept.
+    """
+    # The embedding model and dimension are stored with the vectors so mismatches can be detected
+    dimensions = [len(row["embedding"]) for row in rows if row["embedding"] is not None]
+    tx.run("""
+        MERGE (doc:Document {file_name: $file_name})
+        SET doc.embedding_model = $embedding_model,
+            doc.embedding_dimension = coalesce($embedding_dimension, doc.embedding_dimension)
+        WITH doc
+        UNWIND $rows AS row
+        MERGE (d:Chunk {chunk_id: row.chunk_id})
+        SET d.fileName = $file_name,
+            d.content_hash = row.content_hash,
+            d.position = row.position,
+            d.page_number = row.page_number,
+            d.text = coalesce(row.text, d.text),
+            d.embedding = coalesce(row.embedding, d.embedding),
+            d.embedding_model = CASE WHEN row.embedding IS NULL THEN d.embedding_model ELSE $embedding_model END
+        MERGE (d)-[:PART_OF]->(doc)
+        """, file_name=file_name, rows=rows,
+        embedding_model=get_embedding_model().model_id, embedding_dimension=dimensions[0] if dimensions else None)
+
+def link_related_documents(tx, file_name):
+    # One relationship per pair of files instead of one per pair of chunks
+    tx.run("""
+        MATCH (doc:Document {file_name: $file_name})
+        MATCH (other:Document)<-[:PART_OF]-(:Chunk)
+        WHERE other <> doc
+        WITH DISTINCT doc, other
+        MERGE (doc)-[:RELATED_TO]->(other)
+        """, file_name=file_name)
+
+# Bump the document version so cached FAISS indexes built from the old content get invalidated
+def bump_document_version(file_name):
+    with neo4j_session() as session:
+        session.run("""
+            MERGE (d:Document {file_name: $file_name})
+            SET d.version = coalesce(d.version, 0) + 1,
+                d.updated_at = timestamp()
+            """, file_name=file_name)
+
+# 6. Staged Ingestion Pipeline
+# Extraction, embedding and graph writes run in separate workers connected by bounded queues,
+# so the network-bound stages overlap while backpressure keeps memory flat.
+PIPELINE_QUEUE_SIZE = int(st.secrets.get("PIPELINE_QUEUE_SIZE", 4))
+PIPELINE_EMBED_WORKERS = int(st.secrets.get("PIPELINE_EMBED_WORKERS", 2))
+PIPELINE_GROUP_SIZE = int(st.secrets.get("PIPELINE_GROUP_SIZE", 64))
+
+_STAGE_DONE = object()
+
+class StageTimer:
+    """
+    Accumulates busy seconds and processed items per pipeline stage across worker threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+
+    def record(self, stage, seconds, items=0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"seconds": 0.0, "items": 0})
+            totals["seconds"] += seconds
+            totals["items"] += items
+
+def _put(stage_queue, item, stop):
+    # Blocks while the next stage is behind, but gives up once the pipeline is stopping
+    while not stop.is_set():
+        try:
+            stage_queue.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(stage_queue, stop):
+    while not stop.is_set():
+        try:
+            return stage_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _STAGE_DONE
+
+def ingest_file(source, file_name=None, chunk_size=1000, upload_to_s3=True,
+                group_size=None, embed_workers=None, queue_size=None):
+    """
+    Ingests one file through the staged pipeline: S3 upload in parallel with
+    extract/chunk -> embed -> Neo4j write.
+
+    Parameters:
+    source (str | memoryview): Path of the file to ingest, or its content.
+    file_name (str): Name the document is stored under, defaults to the file's base name. Required for content.
+    chunk_size (int): Characters per chunk.
+    upload_to_s3 (bool): Whether to also upload the original file to S3.
+    group_size (int): Chunks handed from one stage to the next at a time.
+    embed_workers (int): Number of concurrent embedding workers, by default capped by the embedding model's concurrency.
+    queue_size (int): Maximum number of groups waiting between two stages.
+
+    Re-ingesting a document only embeds the chunks whose content changed, deletes the chunks that
+    are gone and bumps the document version when anything changed.
+
+    Returns:
+    dict: The file name, chunk count, chunks embedded, unchanged and deleted, wall time,
+    per-stage timings and the S3 error if any.
+    """
+    file_name = file_name or os.path.basename(source)
+    group_size = group_size or PIPELINE_GROUP_SIZE
+    embed_workers = embed_workers or min(
+        PIPELINE_EMBED_WORKERS, get_embedding_model().max_concurrency or EMBEDDING_MAX_CONCURRENCY
+    )
+    queue_size = queue_size or PIPELINE_QUEUE_SIZE
+
+    ensure_constraints()
+    timer = StageTimer()
+    stop = threading.Event()
+    errors = []
+    chunk_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    report = {"file_name": file_name, "embedded": 0, "written": 0, "unchanged": 0, "deleted": 0, "s3_error": None}
+    report_lock = threading.Lock()
+    batch_size = AdaptiveBatchSize(EMBEDDING_BATCH_SIZE)
+
+    def fail(stage, error):
+        errors.append((stage, error))
+        stop.set()
+
+    def s3_stage():
+        from boto3.s3.transfer import TransferConfig
+
+        started = time.perf_counter()
+        # Parts are uploaded concurrently, reading the file or the buffer the extractor reads too
+        config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_CHUNK_MB * 2 ** 20,
+            multipart_chunksize=S3_MULTIPART_CHUNK_MB * 2 ** 20,
+            max_concurrency=S3_MAX_CONCURRENCY,
+        )
+        try:
+            if isinstance(source, str):
+                get_s3_client().upload_file(source, st.secrets['S3_BUCKET_NAME'], file_name, Config=config)
+            else:
+                with open_source(source) as f:
+                    get_s3_client().upload_fileobj(f, st.secrets['S3_BUCKET_NAME'], file_name, Config=config)
+        except Exception as e:
+            # A failed S3 upload doesn't stop the document from being searchable
+            report["s3_error"] = str(e)
+        timer.record("s3_upload", time.perf_counter() - started, 1)
+
+    # Content-addressed chunks already stored with the current model are neither embedded nor rewritten
+    model_id = get_embedding_model().model_id
+    stored = fetch_stored_chunks(file_name)
+    seen = set()
+
+    def extract_stage():
+        try:
+            new_chunks = []  # embedded, then written
+            moved_chunks = []  # unchanged content at another position, written without embedding
+            started = time.perf_counter()
+            for row in identify_chunks(file_name, chunk_pages(extract_pages(source, file_name), chunk_size)):
+                seen.add(row["chunk_id"])
+                stored_chunk = stored.get(row["chunk_id"])
+                if stored_chunk is None or stored_chunk["embedding_model"] != model_id:
+                    new_chunks.append(row)
+                elif (stored_chunk["page_number"], stored_chunk["position"]) != (row["page_number"], row["position"]):
+                    moved_chunks.append(dict(row, text=None))
+                else:
+                    report["unchanged"] += 1
+
+                for pending, stage_queue in ((new_chunks, chunk_queue), (moved_chunks, write_queue)):
+                    if len(pending) >= group_size:
+                        timer.record("extract", time.perf_counter() - started, len(pending))
+                        if not _put(stage_queue, list(pending), stop):
+                            return
+                        pending.clear()
+                        started = time.perf_counter()
+
+            timer.record("extract", time.perf_counter() - started, len(new_chunks) + len(moved_chunks))
+            for pending, stage_queue in ((new_chunks, chunk_queue), (moved_chunks, write_queue)):
+                if pending and not _put(stage_queue, pending, stop):
+                    return
+        except Exception as e:
+            fail("extract", e)
+        finally:
+            # Moved chunks were queued before this, so the writer sees them before the embedders finish
+            for _ in range(embed_workers):
+                _put(chunk_queue, _STAGE_DONE, stop)
+
+    def embed_stage():
+        try:
+            while True:
+                rows = _get(chunk_queue, stop)
+                if rows is _STAGE_DONE:
+                    break
+                started = time.perf_counter()
+                texts = [row["text"] for row in rows]
+                embeddings = []
+                # Requests are cut to the size shared by all workers, which shrinks while the API pushes back
+                while len(embeddings) < len(texts):
+                    start = len(embeddings)
+                    embeddings += embed_batch_with_retry(texts[start:start + batch_size.value], batch_size)
+                timer.record("embed", time.perf_counter() - started, len(rows))
+                rows = [dict(row, embedding=embedding) for row, embedding in zip(rows, embeddings)]
+                with report_lock:
+                    report["embedded"] += len(rows)
+                if not _put(write_queue, rows, stop):
+                    return
+        except Exception as e:
+            fail("embed", e)
+        finally:
+            _put(write_queue, _STAGE_DONE, stop)
+
+    def write_stage():
+        finished_embedders = 0
+        # Groups are gathered into transactions of NEO4J_WRITE_BATCH_SIZE chunks
+        pending = []
+
+        def write(session, rows):
+            started = time.perf_counter()
+            session.execute_write(write_chunk_batch, file_name, rows)
+            timer.record("write", time.perf_counter() - started, len(rows))
+            report["written"] += len(rows)
+
+        try:
+            with neo4j_session() as session:
+                while finished_embedders < embed_workers:
+                    rows = _get(write_queue, stop)
+                    if rows is _STAGE_DONE:
+                        if stop.is_set():
+                            return
+                        finished_embedders += 1
+                        continue
+                    pending.extend(rows)
+                    while len(pending) >= NEO4J_WRITE_BATCH_SIZE:
+                        write(session, pending[:NEO4J_WRITE_BATCH_SIZE])
+                        del pending[:NEO4J_WRITE_BATCH_SIZE]
+                if pending:
+                    write(session, pending)
+        except Exception as e:
+            fail("write", e)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=extract_stage, name=f"extract-{file_name}")]
+    workers += [threading.Thread(target=embed_stage, name=f"embed-{file_name}-{i}") for i in range(embed_workers)]
+    workers.append(threading.Thread(target=write_stage, name=f"write-{file_name}"))
+    if upload_to_s3:
+        workers.append(threading.Thread(target=s3_stage, name=f"s3-{file_name}"))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        stage, error = errors[0]
+        raise RuntimeError(f"Ingestion of '{file_name}' failed in the {stage} stage: {error}") from error
+
+    finalize_started = time.perf_counter()
+    orphans = [chunk_id for chunk_id in stored if chunk_id not in seen]
+    with neo4j_session() as session:
+        if orphans:
+            session.execute_write(delete_chunks, orphans)
+            report["deleted"] = len(orphans)
+        session.execute_write(link_related_documents, file_name)
+    # Caches built from the previous version are only invalidated when the document changed
+    if report["written"] or report["deleted"]:
+        bump_document_version(file_name)
+        if RETRIEVAL_BACKEND != "neo4j":
+            # Only the FAISS backends keep per-document indexes to rebuild
+            get_index_cache().refresh_async(file_name)
+    timer.record("finalize", time.perf_counter() - finalize_started, 1)
+
+    report["chunks"] = len(seen)
+    report["seconds"] = time.perf_counter() - started
+    report["chunks_per_second"] = report["chunks"] / report["seconds"] if report["seconds"] > 0 else 0.0
+    report["stages"] = timer.stages
+    print(f"Ingested '{file_name}': {report['chunks']} chunks ({report['embedded']} embedded, "
+          f"{report['unchanged']} unchanged, {report['deleted']} deleted) in {report['seconds']:.2f}s "
+          f"({report['chunks_per_second']:.1f} chunks/s), stages: {timer.stages}")
+    return report
 
 def upload_file_to_s3_and_neo4j(uploaded_file):
-    # 1. Save the uploaded file locally
-    file_path = save_uploaded_file(uploaded_file)
-    
-    # 2. Upload file to S3
-    upload_file_to_s3(file_path, uploaded_file.name)
-    
-    # 3. Extract text based on file type
-    document_text = extract_text(file_path)
-    
-    # 4. Chunk the document
-    chunk_size = 1000  # Define your chunk size
-    chunks = [(document_text[i:i + chunk_size], generate_embeddings(document_text[i:i + chunk_size]))
-              for i in range(0, len(document_text), chunk_size)]
-    
-    # 5. Upload extracted text and embeddings to Neo4j
-    upload_to_neo4j(uploaded_file.name, chunks)
+    # 1. Ingest the uploaded bytes from memory, or from a private temporary file when they are large
+    buffer = uploaded_buffer(uploaded_file)
+    if buffer.nbytes <= UPLOAD_MEMORY_LIMIT_MB * 2 ** 20:
+        # 2. Upload to S3 while the text is extracted, embedded and written to Neo4j
+        report = ingest_file(buffer, uploaded_file.name)
+    else:
+        file_path = spill_to_temp_file(buffer, uploaded_file.name)
+        try:
+            report = ingest_file(file_path, uploaded_file.name)
+        finally:
+            os.remove(file_path)
+
+    if report["s3_error"]:
+        st.error(f"Failed to upload file to S3: {report['s3_error']}")
+    else:
+        st.success(f"File '{uploaded_file.name}' uploaded to S3 successfully!")
 
-    # 6. Confirm success
-    st.success("File uploaded and embedded successfully!")
\ No newline at end of file
+    # 3. Confirm success
+    st.success("File uploaded and embedded successfully!")